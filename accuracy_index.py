@@ -10,27 +10,84 @@ class CONFUSION_MATRIX:
         self.confusion_matrix=None
         self.OA=None
         self.Kappa = None
-        
+        self.Kappa_var = None
+
     def compute_confusion_matrix(self,yp,yr):
-        ''' 
-        Compute the confusion matrix
-        '''
-        # Initialization
-        n = yp.size
-        C=int(yr.max())
-        self.confusion_matrix=sp.zeros((C,C))
-        
-        # Compute confusion matrix
-        for i in range(n):
-            self.confusion_matrix[yp[i].astype(int)-1,yr[i].astype(int)-1] +=1
-        
+        '''
+        Compute the confusion matrix, the overall accuracy and the Kappa
+        Input:
+            yp: the predicted labels (rows of the confusion matrix), from 1 to C
+            yr: the reference labels (columns of the confusion matrix), from 1 to C
+        '''
+        self.confusion_matrix=None
+        self.update(yp,yr)
+        self.compute_indices()
+
+    def resize(self,C):
+        '''
+        Extend the confusion matrix to C classes, the counts of the current classes are kept
+        '''
+        if self.confusion_matrix is None:
+            self.confusion_matrix=sp.zeros((C,C))
+        elif self.confusion_matrix.shape[0] < C:
+            temp = sp.zeros((C,C))
+            c = self.confusion_matrix.shape[0]
+            temp[:c,:c] = self.confusion_matrix
+            self.confusion_matrix = temp
+
+    def update(self,yp,yr):
+        '''
+        Add the samples of a batch (e.g. a block of an image) to the confusion matrix. The accuracy indices are not updated,
+        see compute_indices.
+        Input:
+            yp: the predicted labels, from 1 to C
+            yr: the reference labels, from 1 to C
+        '''
+        yp = sp.asarray(yp).ravel().astype(int)-1
+        yr = sp.asarray(yr).ravel().astype(int)-1
+        if yp.size == 0:
+            self.resize(0)
+            return
+        C = max(yp.max(),yr.max())+1
+        self.resize(C)
+        C = self.confusion_matrix.shape[0]
+        self.confusion_matrix += sp.bincount(yp*C+yr,minlength=C*C).reshape(C,C)
+
+    def merge(self,other):
+        '''
+        Add the counts of another confusion matrix, e.g. computed by another process on another part of the data. The
+        accuracy indices are not updated, see compute_indices.
+        Input:
+            other: a CONFUSION_MATRIX object or a confusion matrix
+        '''
+        if isinstance(other,CONFUSION_MATRIX):
+            other = other.confusion_matrix
+        if other is None:
+            return
+        C = max(other.shape[0],0 if self.confusion_matrix is None else self.confusion_matrix.shape[0])
+        self.resize(C)
+        c = other.shape[0]
+        self.confusion_matrix[:c,:c] += other
+
+    def compute_indices(self):
+        '''
+        Compute the overall accuracy, the Kappa and the variance of the Kappa (delta method, Congalton and Green) from the
+        counts of the confusion matrix
+        '''
+        n = sp.sum(self.confusion_matrix)
+
         # Compute overall accuracy
         self.OA=sp.sum(sp.diag(self.confusion_matrix))/n
-        
+
         # Compute Kappa
         nl = sp.sum(self.confusion_matrix,axis=1)
         nc = sp.sum(self.confusion_matrix,axis=0)
-        
+
         self.Kappa = ((n**2)*self.OA - sp.sum(nc*nl))/(n**2-sp.sum(nc*nl))
-        
-        # TBD Variance du Kappa
+
+        # Variance of the Kappa
+        t1 = self.OA
+        t2 = sp.sum(nc*nl)/n**2
+        t3 = sp.sum(sp.diag(self.confusion_matrix)*(nl+nc))/n**2
+        t4 = sp.sum(self.confusion_matrix*(nl.reshape(1,-1)+nc.reshape(-1,1))**2)/n**3
+        self.Kappa_var = (t1*(1-t1)/(1-t2)**2 + 2*(1-t1)*(2*t1*t2-t3)/(1-t2)**3 + (1-t1)**2*(t4-4*t2**2)/(1-t2)**4)/n
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks of PGPDA/NPGPDA/KDA, on wine.data and on a synthetic hyperspectral-like data set.
+
+Usage:
+    python benchmark.py approx [n_per_class]
+        Compare the approximation modes of PGPDA/NPGPDA with the exact models (training time, prediction time and
+        overall accuracy), the results are printed.
+    python benchmark.py suite [-n N] [-d D] [-C C] [--imbalance R] [--dtype T] [--repeat R] [-o results.json] [-b baseline.json]
+        Run the benchmark suite: kernel computation, sq_dist, train, predict and cross_validation of PGPDA, NPGPDA and
+        KDA. Each case is run in its own process, to measure its peak memory. The wall time, the peak memory and the
+        accuracy are written to a JSON file and compared with a baseline file, if any (exit code 1 on regression).
+'''
+import sys
+import os
+import time
+import json
+import subprocess
+import argparse
+import platform
+import scipy as sp
+import profiling
+import kernels
+from pgpda import PGPDA,NPGPDA,KDA,CV,standardize
+from kernels import KERNEL,sq_dist
+from accuracy_index import CONFUSION_MATRIX
+
+def generate_data(n,d=100,C=5,noise=0.05,seed=0,imbalance=1.0):
+    '''
+    Generate a synthetic hyperspectral-like data set: each class has a smooth mean spectrum and its samples vary along
+    a few smooth directions, plus a white noise.
+    Input:
+        n: the number of samples of the largest class
+        d: the number of bands
+        C: the number of classes
+        noise: the standard deviation of the white noise
+        seed: the seed of the random generator
+        imbalance: the ratio between the sizes of the largest and of the smallest class, the sizes decrease
+                   geometrically from the first to the last class
+    Output:
+        x,y: the sample matrix and the label (from 1 to C)
+    '''
+    rs = sp.random.RandomState(seed)
+    t = sp.linspace(0,1,d)
+    ni = [max(2,int(round(n*imbalance**(-float(i)/max(C-1,1))))) for i in range(C)]
+    start = sp.cumsum([0]+ni)
+    x = sp.empty((start[-1],d))
+    y = sp.empty(start[-1])
+    for i in range(C):
+        # Smooth mean spectrum and variations: sums of a few random gaussian bumps
+        centers = rs.rand(4,6)
+        widths = 0.05+0.2*rs.rand(4,6)
+        heights = rs.rand(4,6)
+        basis = sp.asarray([sp.sum(heights[k]*sp.exp(-(t.reshape(d,1)-centers[k])**2/widths[k]**2),axis=1) for k in range(4)])
+        coef = sp.exp(0.5*rs.randn(ni[i],3))
+        x[start[i]:start[i+1],:] = basis[0]+0.3*sp.dot(coef,basis[1:])+noise*rs.randn(ni[i],d)
+        y[start[i]:start[i+1]] = i+1
+    return x,y
+
+def split(x,y,v=2):
+    '''
+    Split the data into a training and a testing set, with the first fold of a stratified v-fold split
+    '''
+    cv = CV()
+    cv.split_data_class(y,v=v)
+    it,iT = cv.it[0],cv.iT[0]
+    return x[it,:],y[it],x[iT,:],y[iT]
+
+def median_sig(x,nmax=1000):
+    '''
+    Kernel parameter given by the median heuristic: sig = 1/median of the squared distances
+    '''
+    D = sq_dist(x[:nmax,:])
+    return 1.0/sp.median(D[sp.triu_indices(D.shape[0],1)])
+
+def run(model,x,y,xt,yt):
+    '''
+    Train and evaluate a model
+    Output:
+        the training time, the prediction time and the overall accuracy
+    '''
+    tic = time.time()
+    model.train(x,y)
+    train_time = time.time()-tic
+    tic = time.time()
+    yp = model.predict(xt)
+    predict_time = time.time()-tic
+    conf = CONFUSION_MATRIX()
+    conf.compute_confusion_matrix(yp.ravel(),yt)
+    return train_time,predict_time,conf.OA
+
+def benchmark_approx(name,x,y,xt,yt,models=('M1','NM1'),m_r=(10,20,50,100,200),approx_r=('uniform','kmeans++','leverage','rff'),dc=10,threshold=0.95):
+    '''
+    Compare the approximation modes with the exact model for several numbers of landmarks (Nystrom) or of random
+    features, the results are printed.
+    approx_r: the samplings of the Nystrom approximation, and 'rff' for the random Fourier features
+    '''
+    sig = median_sig(x)
+    print '\n'+name+': n=%d, nt=%d, d=%d, C=%d, sig=%.3g'%(x.shape[0],xt.shape[0],x.shape[1],int(y.max()),sig)
+    print '%-6s%-10s%-10s%8s%12s%12s%8s'%('model','approx','sampling','m','train (s)','predict (s)','OA')
+    for model in models:
+        cls = NPGPDA if model.startswith('N') else PGPDA
+        res = run(cls(model=model,sig=sig,dc=dc,threshold=threshold),x,y,xt,yt)
+        print '%-6s%-10s%-10s%8s%12.3f%12.3f%8.4f'%((model,'exact','','')+res)
+        for sampling in approx_r:
+            approx = 'rff' if sampling == 'rff' else 'nystrom'
+            for m in m_r:
+                # More random features than landmarks are needed for the same accuracy
+                mf = 4*m if approx == 'rff' else m
+                res = run(cls(model=model,sig=sig,dc=dc,threshold=threshold,approx=approx,m=mf,sampling=sampling),x,y,xt,yt)
+                print '%-6s%-10s%-10s%8d%12.3f%12.3f%8.4f'%((model,approx,'' if approx == 'rff' else sampling,mf)+res)
+
+# Benchmark suite: the cases are described by dictionaries, so they can be sent to a child process and written to
+# the results file.
+SUITE_MODELS = ('M1','NM1','KDA')
+SUITE_OPS = ('kernel','sq_dist','train','predict','cv')
+
+def load_dataset(dataset):
+    '''
+    Load a data set of the suite, standardize it and split it into a training and a testing set
+    Input:
+        dataset: {'name':'wine'} or {'name':'synthetic','n':..,'d':..,'C':..,'imbalance':..,'seed':..}
+    '''
+    if dataset['name'] == 'wine':
+        data = sp.loadtxt(os.path.join(os.path.dirname(os.path.abspath(__file__)),'wine.data'),delimiter=',')
+        x,y = data[:,1:],data[:,0]
+    else:
+        x,y = generate_data(dataset['n'],d=dataset['d'],C=dataset['C'],imbalance=dataset['imbalance'],seed=dataset['seed'])
+    x,M,S = standardize(x)
+    return split(x,y)
+
+def make_suite_model(model,sig,dc=10,threshold=0.95):
+    '''
+    Create the model of a case: 'KDA' or the name of a PGPDA/NPGPDA model
+    '''
+    if model == 'KDA':
+        return KDA(sig=sig)
+    cls = NPGPDA if model.startswith('N') else PGPDA
+    return cls(model=model,sig=sig,dc=dc,threshold=threshold)
+
+def max_rss():
+    '''
+    Peak resident memory of the current process, in MB
+    '''
+    import resource
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r/2.0**20 if sys.platform == 'darwin' else r/2.0**10 # bytes on OS X, kB on Linux
+
+def run_case(case,repeat=2):
+    '''
+    Run a case of the suite in the current process
+    Input:
+        case: {'dataset':..,'op':..,'model':..,'dtype':..}, see SUITE_OPS and SUITE_MODELS ('model' is not used by 'kernel'
+              and 'sq_dist') and kernels.set_dtype
+        repeat: the number of timed runs, the minimum wall time is reported. They follow an untimed run, which pays the
+                one-time costs (JIT compilation, first allocations...).
+    Output:
+        a dictionary with the wall time (s), the peak memory (MB) of the process, the memory (MB) before the timed
+        operation, the accuracy (overall accuracy on the testing set for 'train' and 'predict', one minus the lowest
+        cross-validation error for 'cv', None otherwise) and the counters of the stages of the last run (see profiling)
+    '''
+    kernels.set_dtype(case.get('dtype','float64'))
+    x,y,xt,yt = load_dataset(case['dataset'])
+    sig = median_sig(x)
+    op,model = case['op'],case.get('model')
+    if op == 'predict':
+        clf = make_suite_model(model,sig)
+        clf.train(x,y)
+    base = max_rss()
+
+    wall,accuracy = [],None
+    for r in range(-1,repeat): # r == -1: warm-up run
+        stats = profiling.enable() if r == repeat-1 else profiling.disable()
+        tic = time.time()
+        if op == 'kernel':
+            K = KERNEL()
+            K.compute_kernel(x,sig=sig)
+        elif op == 'sq_dist':
+            D = sq_dist(x)
+        elif op == 'train':
+            clf = make_suite_model(model,sig)
+            clf.train(x,y)
+        elif op == 'predict':
+            yp = clf.predict(xt)
+        elif op == 'cv':
+            sig_r = sig*2.0**sp.arange(-2,3)
+            if model == 'KDA':
+                res = KDA().cross_validation(x,y,v=3,sig_r=sig_r,mu_r=10.0**sp.arange(-9,-4))
+            else:
+                res = make_suite_model(model,sig).cross_validation(x,y,v=3,sig_r=sig_r,threshold_r=sp.linspace(0.85,0.99,5),dc_r=sp.arange(2,20,2))
+        else:
+            raise ValueError('Unknown operation '+str(op))
+        if r >= 0:
+            wall.append(time.time()-tic)
+    profiling.disable()
+
+    if op == 'train':
+        yp = clf.predict(xt)
+    if op in ('train','predict'):
+        conf = CONFUSION_MATRIX()
+        conf.compute_confusion_matrix(sp.asarray(yp).ravel(),yt)
+        accuracy = float(conf.OA)
+    elif op == 'cv':
+        accuracy = float(1-res[2].min())
+    return {'wall':min(wall),'peak_mb':max_rss(),'base_mb':base,'accuracy':accuracy,'stages':stats.as_dict()['stages']}
+
+def case_name(case):
+    d = case['dataset']
+    name = d['name'] if d['name'] == 'wine' else 'synthetic(n=%d,d=%d,C=%d,imbalance=%g)'%(d['n'],d['d'],d['C'],d['imbalance'])
+    model = [case['model']] if case['op'] in ('train','predict','cv') else []
+    return '/'.join([name,case['op']]+model+[case.get('dtype','float64')]) # Cases of different types are not compared
+
+def suite_cases(n=500,d=100,C=5,imbalance=1.0,seed=0,dtype='float64'):
+    '''
+    The cases of the suite, on wine.data and on the synthetic data set
+    '''
+    cases = []
+    for dataset in ({'name':'wine'},{'name':'synthetic','n':n,'d':d,'C':C,'imbalance':imbalance,'seed':seed}):
+        for op in SUITE_OPS:
+            for model in (SUITE_MODELS if op in ('train','predict','cv') else (None,)):
+                cases.append({'dataset':dataset,'op':op,'model':model,'dtype':dtype})
+    return cases
+
+def run_suite(cases,repeat=2,verbose=True):
+    '''
+    Run each case in a child process (python benchmark.py case ...), so the peak memory is the one of the case
+    Output:
+        the list of the results, see run_case, with the name and the description of the case
+    '''
+    results = []
+    for case in cases:
+        out = subprocess.check_output([sys.executable,os.path.abspath(__file__),'case',json.dumps(case),str(repeat)])
+        res = json.loads(out.decode().strip().splitlines()[-1])
+        res['name'],res['case'] = case_name(case),case
+        results.append(res)
+        if verbose:
+            print '%-60s%10.3f%10.1f%10s'%(res['name'],res['wall'],res['peak_mb'],'' if res['accuracy'] is None else '%.4f'%res['accuracy'])
+    return results
+
+def compare(results,baseline,time_tol=1.2,memory_tol=1.2,accuracy_tol=0.01,min_time=0.05):
+    '''
+    Compare the results with a baseline, the ratios are printed
+    Input:
+        results,baseline: lists of results, see run_suite, matched by name (data set, operation, model and type)
+        time_tol,memory_tol: the ratios (current/baseline) of the wall time and of the peak memory above which a case
+                             is reported as a regression
+        accuracy_tol: the decrease of the accuracy above which a case is reported as a regression
+        min_time: the increase of the wall time (s) below which a case is not reported, the shortest cases being noisy
+    Output:
+        the names of the cases with a regression
+    '''
+    base = dict([(res['name'],res) for res in baseline])
+    regressions = []
+    print '\n%-60s%10s%10s%10s'%('case','time','memory','accuracy')
+    for res in results:
+        if res['name'] not in base:
+            print '%-60s%10s'%(res['name'],'new')
+            continue
+        b = base[res['name']]
+        rt = res['wall']/max(b['wall'],1e-6)
+        rm = res['peak_mb']/max(b['peak_mb'],1e-6)
+        da = None if (res['accuracy'] is None or b['accuracy'] is None) else res['accuracy']-b['accuracy']
+        flag = (rt > time_tol and res['wall']-b['wall'] > min_time) or (rm > memory_tol) or (da is not None and da < -accuracy_tol)
+        if flag:
+            regressions.append(res['name'])
+        print '%-60s%9.2fx%9.2fx%10s%s'%(res['name'],rt,rm,'' if da is None else '%+.4f'%da,'  REGRESSION' if flag else '')
+    return regressions
+
+def main_approx(argv):
+    n = int(argv[0]) if len(argv) > 0 else 2000
+
+    # wine.data: the label is in the first column
+    data = sp.loadtxt(os.path.join(os.path.dirname(os.path.abspath(__file__)),'wine.data'),delimiter=',')
+    x,M,S = standardize(data[:,1:])
+    benchmark_approx('wine',*split(x,data[:,0]),m_r=(5,10,20,40),dc=5)
+
+    # Synthetic data set, n samples per class
+    x,y = generate_data(2*n)
+    x,M,S = standardize(x)
+    benchmark_approx('synthetic',*split(x,y))
+
+def main_suite(argv):
+    parser = argparse.ArgumentParser(prog='benchmark.py suite')
+    parser.add_argument('-n',type=int,default=500,help='number of samples of the largest synthetic class')
+    parser.add_argument('-d',type=int,default=100,help='number of synthetic bands')
+    parser.add_argument('-C',type=int,default=5,help='number of synthetic classes')
+    parser.add_argument('--imbalance',type=float,default=1.0,help='ratio between the largest and the smallest class')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--dtype',default='float64',choices=kernels.DTYPES,help='type of the kernel matrices')
+    parser.add_argument('--repeat',type=int,default=2,help='number of timed runs of each case, after a warm-up run, the minimum time is kept')
+    parser.add_argument('-o','--output',default='bench_results.json',help='results file')
+    parser.add_argument('-b','--baseline',default=None,help='results file of the baseline')
+    args = parser.parse_args(argv)
+
+    print '%-60s%10s%10s%10s'%('case','time (s)','peak (MB)','accuracy')
+    results = run_suite(suite_cases(n=args.n,d=args.d,C=args.C,imbalance=args.imbalance,seed=args.seed,dtype=args.dtype),repeat=args.repeat)
+    info = {'python':platform.python_version(),'scipy':sp.__version__,'platform':platform.platform(),
+            'date':time.strftime('%Y-%m-%d %H:%M:%S'),'repeat':args.repeat}
+    with open(args.output,'w') as f:
+        json.dump({'info':info,'results':results},f,indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results,baseline):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'case':
+        # Child process of run_suite: the result is printed on the last line
+        print json.dumps(run_case(json.loads(sys.argv[2]),repeat=int(sys.argv[3])))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        main_suite(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'approx':
+        main_approx(sys.argv[2:])
+    else:
+        main_approx(sys.argv[1:])
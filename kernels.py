@@ -1,210 +1,598 @@
 # -*- coding: utf-8 -*-
 import scipy as sp
-from scipy import weave
-from scipy.weave import converters
+from scipy import linalg
+from scipy.optimize import minimize_scalar
+import math
+import threading
 import  multiprocessing as mp
+import profiling
+try:
+    import numba
+except ImportError:
+    numba = None
 
-def find_optimal_sig(x,y,sig_r=2.0**sp.arange(-5,5,0.5),ncpus=None):
+BACKENDS = ['numpy','numba']
+BACKEND = 'auto' # 'auto' uses numpy for the stored kernel matrices, and numba (if installed) for compute_alignement
+THREAD = threading.local() # Settings of the current thread, see set_thread_backend
+MAX_MEMORY = 2**28 # Default memory budget (in bytes) of the blocked kernel computations
+DTYPES = ['float64','float32']
+DTYPE = sp.float64 # Default type of the kernel and distance matrices, see set_dtype
+
+def set_backend(backend):
+    '''
+    Select the default backend used for the large kernel computations (kernel_rbf, compute_alignement)
+    Input:
+        backend: 'numpy' (blocked computation with BLAS products, no dependencies), 'numba' (JIT compiled, multithreaded
+                 loops, without BLAS) or 'auto': numpy for the kernel matrices (kernel_rbf, KERNEL.compute_kernel), and
+                 numba, when it is installed, for compute_alignement, where the kernel matrix is not stored
+    '''
+    global BACKEND
+    if (backend != 'auto') and (backend not in BACKENDS):
+        raise ValueError('Unknown backend '+str(backend)+', available backends: auto, '+', '.join(BACKENDS))
+    if (backend == 'numba') and (numba is None):
+        raise ImportError('The numba backend requires the numba package')
+    BACKEND = backend
+
+def set_thread_backend(backend=None):
+    '''
+    Select the default backend of the current thread, which overrides the one of set_backend, e.g. 'numpy' in the
+    workers of a thread pool: the parallel regions of numba can not be run from several threads at once with its
+    workqueue threading layer.
+    Input:
+        backend: see set_backend, None to use the one of set_backend
     '''
-    Compute the centered alignement for several value of the kernel parameter 
+    if (backend is not None) and (backend != 'auto') and (backend not in BACKENDS):
+        raise ValueError('Unknown backend '+str(backend)+', available backends: auto, '+', '.join(BACKENDS))
+    THREAD.backend = backend
+
+def get_backend(backend=None,auto='numpy'):
+    '''
+    Return the name of the backend to be used: the given one, or the default one if None (see set_thread_backend and
+    set_backend)
+    Input:
+        backend: the backend, see set_backend
+        auto: the backend selected by 'auto' when numba is installed
+    '''
+    if backend is None:
+        backend = getattr(THREAD,'backend',None)
+    if backend is None:
+        backend = BACKEND
+    if backend == 'auto':
+        backend = 'numpy' if numba is None else auto
+    return backend
+
+def set_dtype(dtype):
+    '''
+    Select the default type of the kernel and distance matrices (KERNEL, kernel_rbf, sq_dist)
+    Input:
+        dtype: 'float64' or 'float32'. With 'float32', the matrices are computed and stored in single precision, which
+               halves their memory and bandwidth, and the numerically sensitive steps are done in double precision: the
+               sums of the centering, the eigen decompositions (see eig_kernel) and the estimation of the parameters.
+    '''
+    global DTYPE
+    if sp.dtype(dtype).name not in DTYPES:
+        raise ValueError('Unknown type '+str(dtype)+', available types: '+', '.join(DTYPES))
+    DTYPE = sp.dtype(dtype).type
+
+def get_dtype(dtype=None):
+    '''
+    Return the type of the matrices to be used: the given one, or the default one if None
+    '''
+    if dtype is None:
+        dtype = DTYPE
+    return sp.dtype(dtype).type
+
+def get_block_size(n,d,max_memory=None,dtype=None):
+    '''
+    Compute the number of rows of the blocks used in the blocked kernel computations, such as a block of kernel
+    rows (n values per row) and the corresponding block of samples (d values per row) fit in the memory budget
+    Input:
+        n: the number of columns of the kernel matrix
+        d: the number of variables
+        max_memory: the memory budget in bytes, default MAX_MEMORY
+        dtype: the type of the kernel matrix, see set_dtype
+    Output:
+        the number of rows of the blocks
+    '''
+    if max_memory is None:
+        max_memory = MAX_MEMORY
+    itemsize = sp.dtype(get_dtype(dtype)).itemsize
+    return int(max(1,max_memory//(itemsize*(n+2*d))))
+
+def find_optimal_sig(x,y,sig_r=2.0**sp.arange(-5,5,0.5),ncpus=None,backend=None,max_memory=None,optimize=False,n_samples=None,n_subsets=10,seed=0,xtol=1e-2):
+    '''
+    Compute the centered alignement for several value of the kernel parameter. When the matrix of squared distances
+    and the kernel matrix fit in the memory budget, the distances are computed once and each kernel is derived from them.
+    Input:
+        x,y: the sample matrix and the label
+        sig_r: the values of the kernel parameter
+        ncpus,backend,max_memory: see compute_alignement
+        optimize: if True, the alignement is maximized over log(sig) by a bounded 1-D search in the bracket given by the
+                  neighbours of the best value of sig_r
+        n_samples: if not None, the alignement is estimated on n_subsets random subsets of n_samples samples, drawn with
+                   the same proportion of each class as in y, and the distances of each subset are computed once
+        n_subsets: the number of subsets
+        seed: the seed of the random generator of the subsets
+        xtol: the tolerance of the search on log(sig)
+    Output:
+        sig: the selected kernel parameter
+        A: the centered alignement for each value of sig_r (the mean over the subsets if n_samples is not None)
+        ci: if n_samples is not None, the 95% confidence interval of the alignement at sig
     '''
     if ncpus is None:
         ncpus=mp.cpu_count()
+    if max_memory is None:
+        max_memory = MAX_MEMORY
+    y = sp.asarray(y).ravel()
+    tic = profiling.start()
     
-    A =  [compute_alignement(sig,x,y,ncpus) for sig in sig_r]
-    A = sp.asarray(A)
+    n = x.shape[0]
+    K = KERNEL()
+    if n_samples is not None:
+        # Stratified subsets: the distances are computed once per subset
+        rs = sp.random.RandomState(seed)
+        labels = sp.unique(y)
+        D = []
+        for b in range(n_subsets):
+            t = []
+            for l in labels:
+                tl = sp.where(y==l)[0]
+                ml = min(tl.size,max(2,int(round(float(n_samples)*tl.size/n))))
+                t.append(rs.choice(tl,ml,replace=False))
+            t = sp.sort(sp.concatenate(t))
+            D.append((sq_dist(x[t,:]),y[t]))
+        def alignements(sig):
+            a = []
+            for Ds,ys in D:
+                K.compute_kernel_from_dist(Ds,sig)
+                a.append(compute_alignement_kernel(K.K,ys))
+            return sp.asarray(a)
+    elif 2*sp.dtype(get_dtype()).itemsize*n**2 <= max_memory: # The distance and kernel matrices
+        Dx = sq_dist(x)
+        def alignements(sig):
+            K.compute_kernel_from_dist(Dx,sig)
+            return sp.asarray([compute_alignement_kernel(K.K,y)])
+    else:
+        def alignements(sig):
+            return sp.asarray([compute_alignement(sig,x,y,ncpus,backend=backend,max_memory=max_memory)])
 
+    A = sp.asarray([alignements(sig).mean() for sig in sig_r])
     t = A.argmax()
-    return sig_r[t],A
-
-def compute_alignement(sig,x,y,ncpus=2):
-    # Get some parameters
-    n,d = sp.shape(x)
-    support_code="""
-    #include <math.h>
-    #include <stdio.h>
-    #include <omp.h>
-    """
-
-    code=r"""
-    int i,j,k,tm;
-    double A=0;
-    double kn=0;
-    double kin=0;
-    double s=0;
-    double ki;
-    double ktp;
-    double *ks = (double*)calloc(n, sizeof(double));
-    double **reduc_ks = (double**)calloc(ncpus, sizeof(double*));
-    for(i=0;i<ncpus;i++)
-        reduc_ks[i]= (double*)calloc(n, sizeof(double));
-    double MSIG = -1.0*(double)sig;
-     
-    # pragma omp parallel for private (i,j,k,ktp,tm) shared(x,MSIG,n,d,reduc_ks)  reduction(+:s) schedule(runtime) num_threads(ncpus)
-    for(i=0;i<n;i++){
-        tm = omp_get_thread_num();
-        reduc_ks[tm][i] += 1;
-        s+=1;
-        for(j=i+1;j<n;j++){
-            ktp = 0;
-            for(k=0;k<d;k++)
-                ktp += (x(i,k)-x(j,k))*(x(i,k)-x(j,k));
-            ktp *= MSIG;
-            ktp = exp(ktp);
-            reduc_ks[tm][i] += 2*ktp;
-            s += 2*ktp;
-        }
-        reduc_ks[tm][i] /= n;
-    }
-    s /= (n*n);
-
-    for(i=0;i<ncpus;i++){
-        for(j=0;j<n;j++)
-            ks[j]+=reduc_ks[i][j];
-        free(reduc_ks[i]);
-    }
-    free(reduc_ks);
-        
-    # pragma omp parallel for private(i,j,k,ktp,ki) shared(x,y,sig,n,d,s,ks) reduction (+:A,kn,kin) num_threads(ncpus) schedule(runtime)
-    for(i=0;i<n;i++){
-        A += 1;
-        kn += 1;
-        kin +=1;
-        for(j=i+1;j<n;j++){
-            ki = (y(i) == y(j)) ? 1 : 0;
-            ktp = 0;
-            for(k=0;k<d;k++)
-                ktp += (x(i,k)-x(j,k))*(x(i,k)-x(j,k));
-            ktp *= MSIG;
-            ktp = exp(ktp);
-            ktp += s -ks[i]-ks[j];
-            A +=2*ktp*ki;
-            kn += 2*ktp*ktp;
-            kin+=2*ki;
-        }
-    }
-    kn = sqrt(kn);
-    kin= sqrt(kin);
-    A /=(kn*kin);   
-    return_val=A;
-    """
-    A=weave.inline(code,['sig','n','d','x','y','ncpus'],support_code=support_code,type_converters = converters.blitz,compiler='gcc',extra_compile_args =['-O3 -fopenmp'], extra_link_args=['-lgomp'],)
+    sig,a = sig_r[t],A[t]
+
+    if optimize and sig_r.size > 1:
+        # Bounded search on log(sig) between the neighbours of the best value of the grid
+        ls = sp.log(sig_r)
+        bounds = (ls[max(t-1,0)],ls[min(t+1,sig_r.size-1)])
+        res = minimize_scalar(lambda l: -alignements(sp.exp(l)).mean(),bounds=bounds,method='bounded',options={'xatol':xtol})
+        if -res.fun > a:
+            sig,a = sp.exp(res.x),-res.fun
+
+    if n_samples is not None:
+        a = alignements(sig)
+        h = 1.96*a.std(ddof=1)/sp.sqrt(a.size) if a.size > 1 else 0.0
+        profiling.stop('find_optimal_sig',tic)
+        return sig,A,(a.mean()-h,a.mean()+h)
+    else:
+        profiling.stop('find_optimal_sig',tic)
+        return sig,A
+
+def compute_alignement_kernel(K,y):
+    '''
+    Compute the alignement between the centered kernel matrix and the label matrix. K is centered in place.
+    Input:
+        K: the kernel matrix
+        y: the label
+    Output:
+        A: the centered alignement
+    '''
+    n = K.shape[0]
+    y = sp.asarray(y).ravel()
+    ks = sp.mean(K,axis=1)
+    s = sp.mean(ks)
+    K -= ks.reshape(n,1)
+    K -= ks.reshape(1,n)
+    K += s
+    A,kin = 0.0,0.0
+    for l in sp.unique(y):
+        t = sp.where(y==l)[0]
+        A += sp.sum(K[t,:][:,t])
+        kin += t.size**2
+    kn = sp.vdot(K,K)
+    return A/(sp.sqrt(kn)*sp.sqrt(kin))
+
+def compute_alignement(sig,x,y,ncpus=2,backend=None,max_memory=None):
+    '''
+    Compute the alignement between the centered RBF kernel matrix and the label matrix (Y_ij = 1 if y_i == y_j).
+    The kernel matrix is never stored: it is computed twice, by blocks of rows (numpy) or element by element (numba).
+    Input:
+        sig: the kernel parameter
+        x,y: the sample matrix and the label
+        ncpus: the number of threads (numba backend)
+        backend: the backend to be used, see set_backend
+        max_memory: the memory budget of the blocks (numpy backend)
+    Output:
+        A: the centered alignement
+    '''
+    tic = profiling.start()
+    x = sp.ascontiguousarray(x,dtype=sp.float64)
+    y = sp.ascontiguousarray(y,dtype=sp.float64).ravel()
+    if get_backend(backend,auto='numba') == 'numba':
+        set_numba_threads(ncpus)
+        A = compute_alignement_numba(x,y,float(sig),sp.empty(x.shape[0]))
+    else:
+        A = compute_alignement_numpy(x,y,float(sig),max_memory=max_memory)
+    profiling.stop('alignment',tic,entries=2*x.shape[0]**2)
     return A
 
-def kernel_rbf(X,sig,Z=None,ncpus=None):
+def compute_alignement_numpy(x,y,sig,max_memory=None):
+    '''
+    Numpy backend of compute_alignement
     '''
-    Compute the kernel matrix using inline C to prevent memory problem. Not the fastest, but surely the safest
+    n = x.shape[0]
+    block_size = get_block_size(n,x.shape[1],max_memory)//2 # Kc and its square
+    block_size = max(1,block_size)
+
+    # First pass: means of the rows of the kernel matrix
+    ks = sp.empty(n)
+    for start in range(0,n,block_size):
+        end = min(start+block_size,n)
+        ks[start:end] = sp.sum(kernel_rbf_numpy(x[start:end,:],sig,Z=x),axis=1)/n
+    s = sp.mean(ks)
+
+    # Second pass: scalar products with the centered kernel matrix
+    A,kn = 0.0,0.0
+    for start in range(0,n,block_size):
+        end = min(start+block_size,n)
+        Kc = kernel_rbf_numpy(x[start:end,:],sig,Z=x)
+        Kc -= ks[start:end].reshape(end-start,1)
+        Kc -= ks.reshape(1,n)
+        Kc += s
+        A += sp.sum(Kc[y[start:end].reshape(end-start,1)==y.reshape(1,n)])
+        kn += sp.sum(Kc**2)
+    kin = sum([sp.sum(y==l)**2 for l in sp.unique(y)])
+    return A/(sp.sqrt(kn)*sp.sqrt(kin))
+
+def kernel_rbf(X,sig,Z=None,ncpus=None,backend=None,max_memory=None,norms=None,dtype=None):
+    '''
+    Compute the kernel matrix without the large intermediate matrices of sq_dist. Not the fastest, but surely the safest
     Input:
     X,Z: the sample matrix
     sig: the kernel parameter
+    ncpus: the number of threads (numba backend)
+    backend: the backend to be used, see set_backend
+    max_memory: the memory budget of the blocks (numpy backend)
+    norms: the mean and squared norms of Z, see sq_norms (numpy backend)
+    dtype: the type of the kernel matrix, see set_dtype
     '''
     if ncpus is None:
         ncpus=mp.cpu_count()
+    X = sp.ascontiguousarray(X,dtype=sp.float64)
+    if Z is not None:
+        Z = sp.ascontiguousarray(Z,dtype=sp.float64)
         
+    if get_backend(backend) == 'numba':
+        set_numba_threads(ncpus)
+        if Z is None:
+            K = sp.empty((X.shape[0],X.shape[0]),dtype=get_dtype(dtype))
+            kernel_rbf_sym_numba(X,float(sig),K)
+        else:
+            K = sp.empty((X.shape[0],Z.shape[0]),dtype=get_dtype(dtype))
+            kernel_rbf_numba(X,Z,float(sig),K)
+    else:
+        K = kernel_rbf_numpy(X,sig,Z=Z,max_memory=max_memory,norms=norms,dtype=dtype)
+
+    return K
+
+def sq_norms(Z):
+    '''
+    Compute the mean of the samples and the squared norms of the centered samples, used by kernel_rbf_numpy. They can be
+    computed once for a fixed set of samples (e.g. the support vectors of a model).
+    Input:
+        Z: the sample matrix
+    Output:
+        mu: the mean vector
+        z2: the squared norms of the centered samples
+    '''
+    mu = sp.mean(Z,axis=0)
+    z2 = sp.sum((Z-mu)**2,axis=1)
+    return mu,z2
+
+def kernel_rbf_numpy(X,sig,Z=None,max_memory=None,norms=None,dtype=None):
+    '''
+    Numpy backend of kernel_rbf: the kernel matrix is computed by blocks of rows, the size of the blocks being derived
+    from the memory budget. The distance, scaling and exponential are done in place in each block of the output, with
+    the squared norms of Z computed once (or given by norms, see sq_norms): the peak memory is the kernel matrix plus a
+    copy of Z and one block of X. The samples are centered in double precision, then the products are done in the type
+    of the kernel matrix (dtype, see set_dtype).
+    '''
+    dtype = get_dtype(dtype)
     if Z is None:
-        n,d = X.shape
-        K = sp.empty((n,n))
-        support_code="""
-        #include <math.h>
-        #include <stdio.h>
-        #include <omp.h>
-        """
-
-        code=r"""
-        int i,j,k;
-        double ktp;
-        double MSIG = -1.0*(double)sig;
-    
-        #pragma omp parallel for private(i,j,k) shared(X,K,n,d) schedule(runtime) num_threads(ncpus)
-        for(i=0;i<n;i++){
-        K(i,i)=1;
-        for(j=i+1;j<n;j++){
-            ktp = 0;
-            for(k=0;k<d;k++)
-                ktp += (X(i,k)-X(j,k))*(X(i,k)-X(j,k));
-            K(i,j)=exp(MSIG*ktp);
-            K(j,i)=K(i,j);
-            }
-        }
-        """
-        weave.inline(code,['X','n','d','K','sig','ncpus'],support_code=support_code,type_converters = converters.blitz,compiler='gcc',extra_compile_args =['-O3 -fopenmp'], extra_link_args=['-lgomp'])
+        Z = X
+    nt,n = X.shape[0],Z.shape[0]
+    block_size = get_block_size(n,X.shape[1],max_memory,dtype)
 
-    else:
-        nt,d = X.shape
-        n=Z.shape[0]
-        
-        K = sp.empty((nt,n))
-        support_code="""
-        #include <math.h>
-        #include <stdio.h>
-        #include <omp.h>
-        """
-
-        code=r"""
-        int i,j,k;
-        double ktp;
-        double MSIG = -1.0*(double)sig;
-        
-        #pragma omp parallel for private(i,j,k) shared(X,Z,K,n,d) schedule(runtime) num_threads(ncpus)
-        for(i=0;i<nt;i++){
-            for(j=0;j<n;j++){
-            ktp = 0;
-            for(k=0;k<d;k++)
-                ktp += (X(i,k)-Z(j,k))*(X(i,k)-Z(j,k));
-            K(i,j)=exp(MSIG*ktp);
-            }
-        }
-        """
-        weave.inline(code,['X','Z','n','nt','d','K','sig','ncpus'],support_code=support_code,type_converters = converters.blitz,compiler='gcc',extra_compile_args =['-O3 -fopenmp'], extra_link_args=['-lgomp'])
+    # Substract the mean value for numerical precision
+    if norms is None:
+        norms = sq_norms(Z)
+    mu = norms[0]
+    z = (Z-mu).astype(dtype,copy=False)
+    z2 = norms[1].reshape(1,n)
 
+    K = sp.empty((nt,n),dtype=dtype)
+    for start in range(0,nt,block_size):
+        end = min(start+block_size,nt)
+        x = (X[start:end,:]-mu).astype(dtype,copy=False)
+        Kb = K[start:end,:]
+        sp.dot(x,z.T,out=Kb)
+        Kb *= -2
+        Kb += sp.sum(x**2,axis=1).reshape(end-start,1)
+        Kb += z2
+        sp.maximum(Kb,0,out=Kb)
+        Kb *= (-1.0*sig)
+        sp.exp(Kb,out=Kb)
     return K
 
-def sq_dist(X,Z=None):
+if numba is not None:
+    @numba.njit(parallel=True,cache=True)
+    def kernel_rbf_numba(X,Z,sig,K):
+        '''
+        Numba backend of kernel_rbf, cross kernel K(X,Z)
+        '''
+        nt,d = X.shape
+        n = Z.shape[0]
+        for i in numba.prange(nt):
+            for j in range(n):
+                ktp = 0.0
+                for k in range(d):
+                    ktp += (X[i,k]-Z[j,k])*(X[i,k]-Z[j,k])
+                K[i,j] = math.exp(-sig*ktp)
+
+    @numba.njit(parallel=True,cache=True)
+    def kernel_rbf_sym_numba(X,sig,K):
+        '''
+        Numba backend of kernel_rbf, kernel K(X,X): only the upper part is computed
+        '''
+        n,d = X.shape
+        for i in numba.prange(n):
+            K[i,i] = 1.0
+            for j in range(i+1,n):
+                ktp = 0.0
+                for k in range(d):
+                    ktp += (X[i,k]-X[j,k])*(X[i,k]-X[j,k])
+                K[i,j] = math.exp(-sig*ktp)
+                K[j,i] = K[i,j]
+
+    @numba.njit(parallel=True,cache=True)
+    def compute_alignement_numba(x,y,sig,ks):
+        '''
+        Numba backend of compute_alignement, ks is a buffer of size n for the means of the rows of the kernel matrix
+        '''
+        n,d = x.shape
+
+        # First pass: means of the rows of the kernel matrix
+        s = 0.0
+        for i in numba.prange(n):
+            ktp_s = 0.0
+            for j in range(n):
+                ktp = 0.0
+                for k in range(d):
+                    ktp += (x[i,k]-x[j,k])*(x[i,k]-x[j,k])
+                ktp_s += math.exp(-sig*ktp)
+            ks[i] = ktp_s/n
+            s += ktp_s/n
+        s /= n
+
+        # Second pass: scalar products with the centered kernel matrix, using the symmetry
+        A = 0.0
+        kn = 0.0
+        kin = 0.0
+        for i in numba.prange(n):
+            ktp = 1.0 + s - 2*ks[i]
+            A += ktp
+            kn += ktp*ktp
+            kin += 1
+            for j in range(i+1,n):
+                ktp = 0.0
+                for k in range(d):
+                    ktp += (x[i,k]-x[j,k])*(x[i,k]-x[j,k])
+                ktp = math.exp(-sig*ktp) + s - ks[i] - ks[j]
+                if y[i] == y[j]:
+                    A += 2*ktp
+                    kin += 2
+                kn += 2*ktp*ktp
+        return A/(math.sqrt(kn)*math.sqrt(kin))
+
+    def set_numba_threads(ncpus):
+        '''
+        Set the number of threads used by the numba backend
+        '''
+        if (ncpus is not None) and hasattr(numba,'set_num_threads'):
+            numba.set_num_threads(max(1,min(ncpus,numba.config.NUMBA_NUM_THREADS)))
+
+def sq_dist(X,Z=None,dtype=None):
     '''
     The function to computes a matrix of all pairwise squared distances between two sets of vectors
     Substract the mean value for numerical precision
     
     (x-z)^2 = x^2+z^2-2<x,z>
+
+    The matrix is of type dtype (see set_dtype), the mean is substracted in double precision.
     '''
-    x=X.copy()
+    tic = profiling.start()
+    dtype = get_dtype(dtype)
+    x=sp.array(X,dtype=sp.float64)
      
     if Z is None:
         z=x
         nx = x.shape[0]
         mu = sp.mean(x,axis=0)
         x-=mu
-        z-=mu
+        z = x = x.astype(dtype,copy=False)
         D = -2*sp.dot(x,z.T)
         x2 = sp.sum(x**2,axis=1)
         D += x2.reshape(nx,1)
         D += x2.T.reshape(1,nx)
     else:
-        z=Z.copy() 
+        z=sp.array(Z,dtype=sp.float64)
         nx,nz = x.shape[0],z.shape[0]
         n = nx+nz        
         mu = (nx*sp.mean(x,axis=0)+nz*sp.mean(x,axis=0))/n
         x -= mu
         z -= mu
+        x,z = x.astype(dtype,copy=False),z.astype(dtype,copy=False)
         D = -2*sp.dot(x,z.T)
         D += sp.sum(x**2,axis=1).reshape(nx,1)
         D += sp.sum(z**2,axis=1).T.reshape(1,nz)
                 
+    profiling.stop('distance',tic,entries=D.size,bytes=D.nbytes)
     return D
     
+def select_landmarks(x,m,sampling='uniform',kernel='RBF',sig=None,seed=0):
+    '''
+    Select the landmark points of the Nystrom approximation among the samples
+    Input:
+        x: the sample matrix
+        m: the number of landmarks, all the samples are selected if m >= n
+        sampling: 'uniform' (random sampling), 'kmeans++' (k-means++ seeding in the feature space, the landmarks are
+                  spread over the data) or 'leverage' (sampling with probabilities given by the ridge leverage scores,
+                  approximated from a uniform sketch of 2m samples)
+        kernel,sig: the kernel and its parameter
+        seed: the seed of the random generator
+    Output:
+        idx: the indices of the landmarks
+    '''
+    n = x.shape[0]
+    rs = sp.random.RandomState(seed)
+    if m >= n:
+        return sp.arange(n)
+
+    if sampling == 'uniform':
+        idx = rs.permutation(n)[:m]
+    elif sampling == 'kmeans++':
+        # Squared distances in the feature space: k(x,x)+k(c,c)-2k(x,c)
+        kd,kc = KERNEL(),KERNEL()
+        kd.compute_diag_kernel(x,kernel=kernel,sig=sig)
+        kd = kd.K.ravel()
+        idx = [rs.randint(n)]
+        dist = sp.full(n,sp.inf)
+        for j in range(1,m):
+            kc.compute_kernel(x,z=x[idx[-1:],:],kernel=kernel,sig=sig)
+            sp.minimum(dist,kd+kd[idx[-1]]-2*kc.K.ravel(),out=dist)
+            dist[dist<0] = 0
+            total = sp.sum(dist)
+            if total <= 0: # All the samples are already selected
+                break
+            idx.append(rs.choice(n,p=dist/total))
+        idx = sp.asarray(idx)
+    elif sampling == 'leverage':
+        # Features of a uniform sketch, then ridge leverage scores diag(F(F'F+lambda I)^-1 F')
+        t = rs.permutation(n)[:min(n,2*m)]
+        Ks,Kns = KERNEL(),KERNEL()
+        Ks.compute_kernel(x[t,:],kernel=kernel,sig=sig)
+        Kns.compute_kernel(x,z=x[t,:],kernel=kernel,sig=sig)
+        F = sp.dot(Kns.K,nystrom_map(Ks.K))
+        del Ks,Kns
+        G = sp.dot(F.T,F)
+        G.flat[::G.shape[0]+1] += 1e-3*sp.trace(G)/m
+        lev = sp.sum(F*linalg.solve(G,F.T,assume_a='pos').T,axis=1)
+        lev[lev<0] = 0
+        idx = rs.choice(n,m,replace=False,p=lev/sp.sum(lev))
+    else:
+        raise ValueError('Unknown sampling '+str(sampling)+', available samplings: uniform, kmeans++, leverage')
+    return sp.sort(idx)
+
+def nystrom_map(Kl):
+    '''
+    Compute the linear map of the Nystrom approximation: the features of a sample x are k(x,L)W, where L are the
+    landmarks and W = U diag(E)^(-1/2) is obtained from the eigendecomposition of the kernel matrix of the landmarks.
+    The eigenvalues below the numerical precision are discarded.
+    Input:
+        Kl: the kernel matrix of the landmarks, of size m x m
+    Output:
+        W: the map, of size m x r with r <= m the numerical rank of Kl
+    '''
+    E,U = linalg.eigh(sp.asarray(Kl,dtype=sp.float64))
+    t = E > sp.finfo(sp.float64).eps*Kl.shape[0]*E.max()
+    return U[:,t]/sp.sqrt(E[t])
+
+def pivoted_cholesky(x,r,kernel='RBF',sig=None,K=None,tol=1e-10):
+    '''
+    Compute a low rank factor L of the kernel matrix, K ~ LL', with the pivoted (incomplete) Cholesky decomposition: at
+    each step, the sample with the largest residual diagonal is selected and only its kernel column is computed. It is
+    a Nystrom approximation whose landmarks are selected greedily. The cost is O(n*r*(r+d)).
+    Input:
+        x: the sample matrix nxd
+        r: the maximum rank
+        kernel,sig: the kernel and its parameter
+        K: the kernel matrix, used instead of x if given
+        tol: the decomposition stops when the trace of the residual is below tol times the trace of the kernel
+    Output:
+        L: the factor, of size n x r' with r' <= r
+    '''
+    if K is None:
+        kd = KERNEL()
+        kd.compute_diag_kernel(x,kernel=kernel,sig=sig)
+        diag = kd.K.ravel().copy()
+    else:
+        diag = sp.diag(K).copy()
+    n = diag.size
+    r = min(r,n)
+    stop = tol*sp.sum(diag)
+    L = sp.zeros((n,r))
+    Kp = KERNEL()
+    for j in range(r):
+        p = diag.argmax()
+        if (sp.sum(diag) <= stop) or (diag[p] <= 0):
+            return L[:,0:j]
+        if K is None:
+            Kp.compute_kernel(x,z=x[p:p+1,:],kernel=kernel,sig=sig,dtype=sp.float64)
+            col = Kp.K.ravel()
+        else:
+            col = K[:,p].copy()
+        col -= sp.dot(L[:,0:j],L[p,0:j])
+        L[:,j] = col/sp.sqrt(diag[p])
+        diag -= L[:,j]**2
+        diag[p] = 0
+    return L
+
+def rff_map(d,D,sig,seed=0):
+    '''
+    Draw the random frequencies and phases of the random Fourier features of the RBF kernel exp(-sig*||x-z||^2): the
+    features of a sample x are sqrt(2/D)*cos(xW+phase), and their inner products approximate the kernel.
+    Input:
+        d: the number of variables
+        D: the number of features
+        sig: the kernel parameter
+        seed: the seed of the random generator
+    Output:
+        W: the frequencies, of size d x D, drawn from N(0,2*sig*I)
+        phase: the phases, of size D, drawn from U[0,2pi]
+    '''
+    rs = sp.random.RandomState(seed)
+    W = rs.randn(d,D)*sp.sqrt(2.0*sig)
+    phase = rs.uniform(0,2*sp.pi,D)
+    return W,phase
+
 class KERNEL:
     def __init__(self):
         self.K=0
         self.rank=0
         self.kd=0
+        self.km=None
+        self.s=None
         
-    def compute_kernel(self,x,z=None,kernel='RBF',sig=None):
+    def compute_kernel(self,x,z=None,kernel='RBF',sig=None,max_memory=None,norms=None,dtype=None):
         ''' 
-        Compute the kernel matrix and the rank of the kernel
+        Compute the kernel matrix and the rank of the kernel, with the backend selected by set_backend (see kernel_rbf)
         Input:
             x : the sample matrix nxd (number of samples x number of variables)
             z : idem 
             kernel : the kernel used. Default: RBF.
             sig : the kernel parameter
+            max_memory : the memory budget (in bytes) of the blocks used to compute the kernel, default MAX_MEMORY
+            norms : the mean and squared norms of z (see sq_norms), computed if None
+            dtype : the type of the kernel matrix, see set_dtype
 
         '''
         # Free memory
@@ -217,24 +605,51 @@ class KERNEL:
             exit()
             
         if kernel == 'RBF':
+            tic = profiling.start()
             n = x.shape[0]
             self.rank= n
-            if z is None:
-                D = sq_dist(x,z)
-                D *= (-1.0*sig)
-                self.K = sp.exp(D)
-                del D
-            else:
-                nt = z.shape[0]
-                if nt*n>10**8:# To be adjusted in function of the RAM   
-                    self.K = kernel_rbf(x,sig,Z=z)
-                else:
-                    D = sq_dist(x,z)
-                    D *= (-1.0*sig)
-                    self.K = sp.exp(D)
-                    del D
+            self.K = kernel_rbf(x,sig,Z=z,max_memory=max_memory,norms=norms,dtype=dtype)
+            profiling.stop('kernel',tic,entries=self.K.size,bytes=self.K.nbytes)
             
       
+    def compute_rff(self,x,W,phase,dtype=None):
+        '''
+        Compute the random Fourier features of the samples (see rff_map), one row per sample
+        Input:
+            x : the sample matrix nxd
+            W,phase : the frequencies and the phases of the features
+            dtype : the type of the features, see set_dtype
+        '''
+        tic = profiling.start()
+        dtype = get_dtype(dtype)
+        self.K = sp.dot(sp.asarray(x,dtype=dtype),sp.asarray(W,dtype=dtype))
+        self.K += phase
+        sp.cos(self.K,out=self.K)
+        self.K *= sp.sqrt(2.0/W.shape[1])
+        self.rank = W.shape[1]
+        self.kd = 0
+        profiling.stop('rff',tic,entries=self.K.size,bytes=self.K.nbytes)
+
+    def compute_kernel_from_dist(self,D,sig,kernel='RBF'):
+        '''
+        Compute the kernel matrix from the matrix of squared distances (see sq_dist), such as the distances are computed
+        once for several values of the kernel parameter. The kernel is computed in place in the current matrix if it has
+        the same size and type. The kernel matrix has the type of D.
+        Input:
+            D : the matrix of squared distances
+            kernel : the kernel used. Default: RBF.
+            sig : the kernel parameter
+        '''
+        if kernel == 'RBF':
+            tic = profiling.start()
+            if not (isinstance(self.K,sp.ndarray) and (self.K.shape == D.shape) and (self.K.dtype == D.dtype)):
+                self.K = sp.empty(D.shape,dtype=D.dtype)
+            sp.multiply(D,-1.0*sig,out=self.K)
+            sp.exp(self.K,out=self.K)
+            self.rank = D.shape[0]
+            self.kd = 0
+            profiling.stop('kernel',tic,entries=self.K.size,bytes=self.K.nbytes)
+        
     def compute_diag_kernel(self,x,kernel='RBF',sig=None):
         '''
         The function computes the kernel evaluation K(x_i,x_i)
@@ -245,27 +660,38 @@ class KERNEL:
     def scale_kernel(self,s):
         self.K/=s
         
-    def center_kernel(self,Ko=None,kd=None):
+    def center_kernel(self,Ko=None,kd=None,km=None,s=None):
         '''
         The function center the kernel matrix. If the second argument is provided, it is used as the reference for the centering.
+        When a training kernel is centered, its column means and its mean are stored in self.km and self.s. The sums are
+        done in double precision.
         Input:
             Ko: the reference kernel matrix (for testing)
             Kd: the diagonal kernel matrix (for testing)
+            km: the column means of the reference kernel matrix (for testing, used instead of Ko)
+            s: the mean of the reference kernel matrix (for testing, used instead of Ko)
+            km and s are given together, e.g. the statistics self.km and self.s of the centered training kernel.
         '''
-        if Ko is None:
+        if (km is None) != (s is None):
+            raise ValueError('The column means km and the mean s of the reference kernel must be given together')
+        tic = profiling.start()
+        if (Ko is None) and (km is None):
             n = self.K.shape[0]
-            s = sp.sum(self.K)/n**2
-            ks = sp.sum(self.K,axis=0).reshape(n,1)/n
+            s = sp.sum(self.K,dtype=sp.float64)/n**2
+            ks = sp.sum(self.K,axis=0,dtype=sp.float64).reshape(n,1)/n
             self.K -= ks
             self.K -= ks.T
             self.K += s
+            self.km = ks.reshape(n)
+            self.s = s
             del ks, s
         else:
             nt,ni =  self.K.shape
-            s = sp.sum(Ko.K)/(ni**2)
-            kos = sp.sum(Ko.K,axis=1).reshape(ni,1)/ni
-            ks = sp.sum(self.K,axis=1).reshape(nt,1)/ni
-            self.K -= kos.T
+            if km is None:
+                s = sp.sum(Ko.K,dtype=sp.float64)/(ni**2)
+                km = sp.sum(Ko.K,axis=1,dtype=sp.float64)/ni
+            ks = sp.sum(self.K,axis=1,dtype=sp.float64).reshape(nt,1)/ni
+            self.K -= km.reshape(1,ni)
             self.K -= ks
             self.K += s
                         
@@ -273,6 +699,26 @@ class KERNEL:
             kd.K += s
             kd.K.shape = (nt,)
             
-            del kos,ks,s
+            del km,ks,s
+        profiling.stop('center',tic)
 
-    
+    def center_features(self,kd=None,mu=None):
+        '''
+        The function centers explicit features (Nystrom or random Fourier features) stored in self.K, one row per sample. When the
+        features of training samples are centered, their mean is stored in self.km (and self.s is set to 0).
+        Input:
+            kd: the diagonal kernel matrix (for testing). It is replaced by the squared norms of the centered features,
+                plus the part of k(x,x) which is not represented by the features.
+            mu: the mean of the training features (for testing)
+        '''
+        tic = profiling.start()
+        if mu is None:
+            self.km = sp.mean(self.K,axis=0,dtype=sp.float64)
+            self.s = 0.0
+            self.K -= self.km
+        else:
+            nt = self.K.shape[0]
+            kd.K = kd.K.reshape(nt)-sp.sum(self.K**2,axis=1,dtype=sp.float64)
+            self.K -= mu
+            kd.K += sp.sum(self.K**2,axis=1,dtype=sp.float64)
+        profiling.stop('center',tic)
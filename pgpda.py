@@ -1,55 +1,368 @@
 # -*- coding: utf-8 -*-
 import scipy as sp
 from scipy import linalg
-from kernels import KERNEL
+from scipy.sparse.linalg import eigsh,lobpcg,LinearOperator
+from numpy.lib import format
+import zipfile
+import struct
+import os
+import shutil
+import tempfile
+import warnings
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+try:
+    from threadpoolctl import threadpool_limits # Optional dependency, to limit the BLAS threads of the parallel workers
+except ImportError:
+    threadpool_limits = None
+BLAS_WARNING = True # Warn once when the BLAS threads can not be limited, see warn_blas_threads
+from kernels import KERNEL,sq_dist,sq_norms,get_block_size,select_landmarks,nystrom_map,rff_map,pivoted_cholesky,set_thread_backend
 from accuracy_index import *
+import profiling
 
-def pre_compute_E_Beta(x,y,sig,kernel='RBF'):
+MODELS = ('M0','M1','M2','M3','M4','M5','M6','NM0','NM1','NM2','NM3','NM4') # The parsimonious models
+MODELS_DC = ('M1','M3','M4','M6','NM1','NM3','NM4') # The models with a common signal dimension dc
+
+def pre_compute_E_Beta(x,y,sig,kernel='RBF',D_=None,solver='full',d=None,threshold=None,X0_=None,n_jobs=1,parallel='thread'):
     '''
-    Function that pre computes the kernel eigenvalues/eigenfunctions during the cross-validation
+    Function that pre computes the kernel eigenvalues/eigenfunctions during the cross-validation, or for several models
+    learned on the same samples (see train_models)
     Input:
     x,y: the sample matrix and the label
     sig: the value of the kernel parameters
+    D_: a list of the squared distances matrices of each class (optional), used instead of x to compute the kernels
+    solver,d,threshold: the eigen solver and the number of eigenpairs or the cumulative variance needed (see eig_kernel)
+    X0_: a list of the initial eigenvectors of each class for the 'lobpcg' solver (optional, see eig_kernel)
+    n_jobs,parallel: the number of classes processed in parallel and the kind of workers, see map_classes
     Output:
     E_: a list of eigenvalues
     Beta_: a list of corresponding eigenvectors
+    S_: a list of the centering statistics (column means, mean) and of the trace of the class kernels
     '''
     C = int(y.max())
-    eps = sp.finfo(sp.float64).eps      
     E_=[]
     Beta_=[]
+    S_=[]
 
-    for i in range(C):
-        t = sp.where(y==(i+1))[0]
-        ni=t.size
-        Ki= KERNEL()
-        Ki.compute_kernel(x[t,:],kernel=kernel,sig=sig)
-        Ki.center_kernel()
-        Ki.scale_kernel(ni)
-        
-        E,Beta = linalg.eigh(Ki.K)
-        idx = E.argsort()[::-1]
-        E = E[idx]
-        E[E<eps]=eps
-        Beta = Beta[:,idx]
+    if X0_ is None:
+        X0_ = [None]*C
+    if D_ is None:
+        units = ((x[sp.where(y==(i+1))[0],:],None,None,kernel,sig,solver,d,threshold,X0_[i]) for i in range(C))
+    else:
+        units = ((None,None,D_[i],kernel,sig,solver,d,threshold,X0_[i]) for i in range(C))
+    for E,Beta,S,rank in map_classes(class_eigen,units,n_jobs=n_jobs,parallel=parallel):
         E_.append(E)
         Beta_.append(Beta)
+        S_.append(S)
+
+    return E_,Beta_,S_
+
+def class_eigen(args):
+    '''
+    Function that computes the eigen decomposition of the kernel of one class: kernel, centering, scaling by the number
+    of samples and leading eigenpairs. The classes are independent, so it can be run in parallel (see map_classes).
+    Input:
+    args: a tuple (xi,Ki,Di,kernel,sig,solver,d,threshold[,X0]) with only one of
+        xi: the samples of the class
+        Ki: the kernel matrix of the class
+        Di: the squared distances matrix of the class
+    and the kernel, its parameter, the eigen solver, the number of eigenpairs or the cumulative variance and optionally
+    the initial eigenvectors (see eig_kernel)
+    Output:
+    E,Beta: the eigenvalues and eigenvectors
+    S: the centering statistics (column means, mean) and the trace of the centered scaled kernel
+    rank: the rank of the kernel
+    '''
+    xi,Kp,Di,kernel,sig,solver,d,threshold = args[:8]
+    X0 = args[8] if len(args) > 8 else None
+    Ki = KERNEL()
+    if xi is not None:
+        Ki.compute_kernel(xi,kernel=kernel,sig=sig)
+    elif Di is not None:
+        Ki.compute_kernel_from_dist(Di,sig,kernel=kernel)
+    else:
+        Ki.K = Kp
+        Ki.rank = Ki.K.shape[0]
+    ni = Ki.K.shape[0]
+    Ki.center_kernel()
+    Ki.scale_kernel(ni)
+    TraceKi = sp.trace(Ki.K,dtype=sp.float64)
+
+    E,Beta = eig_kernel(Ki.K,d=d,solver=solver,threshold=threshold,trace=TraceKi,X0=X0)
+    return E,Beta,(Ki.km,Ki.s,TraceKi),Ki.rank
+
+def feature_eigen(Fi,solver='full',d=None,threshold=None):
+    '''
+    Function that computes the eigen decomposition of the covariance of one class in an explicit feature space. The
+    eigenvalues are those of the centered scaled kernel of the features, and the eigenvectors are scaled such as the
+    projections of the features on them are the projections of the kernel on the kernel eigenvectors: the models are
+    learned and evaluated as with the exact kernel.
+    Input:
+    Fi: a KERNEL object with the features of the class, of size ni x r
+    solver,d,threshold: the eigen solver and the number of eigenpairs or the cumulative variance (see eig_kernel)
+    Output:
+    E,Beta: the eigenvalues and the scaled eigenvectors, of size r x d
+    S: the centering statistics (feature mean, 0) and the trace of the covariance
+    rank: the rank of the covariance, at most the dimension r of the feature space
+    '''
+    tic = profiling.start()
+    ni,r = Fi.K.shape
+    Fi.center_features()
+    F = sp.asarray(Fi.K,dtype=sp.float64) # The covariance is computed in double precision
+    Sigma = sp.dot(F.T,F)
+    del F
+    Sigma /= ni
+    TraceSi = sp.trace(Sigma)
+
+    E,Beta = eig_kernel(Sigma,d=d,solver=solver,threshold=threshold,trace=TraceSi)
+    Beta *= sp.sqrt(ni*E)
+    profiling.stop('feature_eigen',tic)
+    return E,Beta,(Fi.km,Fi.s,TraceSi),min(r,ni)
+
+def class_eigen_nystrom(args):
+    '''
+    Function that computes the eigen decomposition of one class with the Nystrom approximation of its kernel: selection
+    of the landmarks, Nystrom map and eigen decomposition in the feature space of dimension r <= m. The cost is
+    O(ni*m*(d+m)) instead of O(ni^3).
+    Input:
+    args: a tuple (xi,kernel,sig,m,sampling,seed,solver,d,threshold) with the samples of the class, the kernel and its
+    parameter, the number of landmarks, the sampling of the landmarks and the seed (see select_landmarks), and the eigen
+    solver and the number of eigenpairs or the cumulative variance (see eig_kernel)
+    Output:
+    E,Beta,S,rank: see feature_eigen. S also contains the landmarks and the Nystrom map.
+    '''
+    xi,kernel,sig,m,sampling,seed,solver,d,threshold = args
+    L = xi[select_landmarks(xi,m,sampling=sampling,kernel=kernel,sig=sig,seed=seed),:]
+    Fi = KERNEL()
+    Fi.compute_kernel(L,kernel=kernel,sig=sig)
+    W = nystrom_map(Fi.K)
+    Fi.compute_kernel(xi,z=L,kernel=kernel,sig=sig)
+    Fi.K = sp.dot(Fi.K,W)
+
+    E,Beta,S,rank = feature_eigen(Fi,solver=solver,d=d,threshold=threshold)
+    return E,Beta,S+(L,W),rank
+
+def class_eigen_rff(args):
+    '''
+    Function that computes the eigen decomposition of one class in the space of the random Fourier features of the RBF
+    kernel (see rff_map). The cost is O(ni*D*(d+D)) instead of O(ni^3).
+    Input:
+    args: a tuple (xi,W,phase,solver,d,threshold) with the samples of the class, the frequencies and the phases of the
+    features, and the eigen solver and the number of eigenpairs or the cumulative variance (see eig_kernel)
+    Output:
+    E,Beta,S,rank: see feature_eigen
+    '''
+    xi,W,phase,solver,d,threshold = args
+    Fi = KERNEL()
+    Fi.compute_rff(xi,W,phase)
+    return feature_eigen(Fi,solver=solver,d=d,threshold=threshold)
+
+def limit_blas_threads(nthreads):
+    '''
+    Function that limits the number of threads of the BLAS library. It needs the threadpoolctl package (optional
+    dependency), otherwise nothing is done (see warn_blas_threads).
+    Input:
+    nthreads: the number of threads
+    Output:
+    limits: the object to restore the previous limits, or None
+    '''
+    if threadpool_limits is None:
+        return None
+    return threadpool_limits(limits=nthreads,user_api='blas')
+
+def warn_blas_threads():
+    '''
+    Function that warns once, in the parent process, when threadpoolctl is not installed: the BLAS threads of the
+    parallel workers can not be limited and the cpus may be oversubscribed.
+    '''
+    global BLAS_WARNING
+    if (threadpool_limits is None) and BLAS_WARNING:
+        BLAS_WARNING = False
+        warnings.warn('threadpoolctl is not installed: the number of BLAS threads of the parallel workers can not be '
+                      'limited and the cpus may be oversubscribed (pip install threadpoolctl)',RuntimeWarning)
+
+def map_classes(function,units,n_jobs=1,parallel='thread'):
+    '''
+    Function that applies function to the units (one per class), serially or in parallel. The results are yielded in the
+    order of the units, as soon as they are available. In parallel, the number of BLAS threads of each worker is limited
+    to cpu_count/n_jobs such as the workers do not oversubscribe the cpus (see limit_blas_threads).
+    Input:
+    function: the function to apply, e.g. class_eigen
+    units: the arguments of each call
+    n_jobs: the number of workers, -1 for all the cpus
+    parallel: 'thread' (thread pool, for the BLAS bound work, the kernels are computed with the numpy backend) or
+              'process' (process pool, for large classes)
+    Output:
+    the results, as a generator
+    '''
+    if n_jobs == -1:
+        n_jobs = mp.cpu_count()
+    if n_jobs == 1:
+        for u in units:
+            yield function(u)
+        return
+    
+    nthreads = max(1,mp.cpu_count()//n_jobs)
+    limits = None
+    warn_blas_threads()
+    if parallel == 'thread':
+        pool = ThreadPool(n_jobs,initializer=set_thread_backend,initargs=('numpy',))
+        limits = limit_blas_threads(nthreads)
+    else:
+        pool = mp.Pool(n_jobs,initializer=limit_blas_threads,initargs=(nthreads,))
+    try:
+        for r in pool.imap(function,units):
+            yield r
+    finally:
+        pool.close()
+        pool.join()
+        if limits is not None:
+            limits.restore_original_limits()
+
+def eig_kernel(K,d=None,solver='full',threshold=None,trace=None,X0=None):
+    '''
+    Function that computes the leading eigenvalues/eigenvectors of a symmetric kernel matrix, in decreasing order
+    Input:
+    K: the kernel matrix of size n x n
+    d: the number of eigenpairs to compute. If None, all of them, or with a partial solver and a threshold, the smallest
+       number of eigenpairs whose cumulative variance reaches the threshold (adaptive mode). In the adaptive mode, the
+       first number of eigenpairs is guessed from the effective rank trace^2/||K||_F^2 (or is the number of columns of
+       X0) and, when it is not enough, it is doubled while it is below n/10 (iterative solvers), otherwise all the
+       eigenpairs are computed: the LAPACK subset driver can not reuse a previous solve, and the iterative solvers are
+       slower than a full decomposition beyond a small fraction of the spectrum.
+    solver: 'full' (all the eigenpairs), 'subset' (LAPACK driver restricted to the d leading eigenpairs), 'iterative'
+            (Lanczos iterations, for large n), 'lobpcg' (block iterations started from X0, see eig_lobpcg, with the
+            'subset' solver as a fallback), or 'auto' ('subset' for n <= 2000, 'iterative' otherwise, and 'full' in the
+            adaptive mode, where the number of eigenpairs is not known in advance)
+    threshold: the percentage of the cumulative variance (adaptive mode)
+    trace: the trace of K, computed if None
+    X0: the initial eigenvectors of the 'lobpcg' solver, e.g. the eigenvectors of a close problem (optional)
+    The eigen decomposition is done in double precision. For a single precision K (see kernels.set_dtype), the 'full'
+    and 'subset' solvers work on a double precision copy of K, while the products of the 'iterative' and 'lobpcg'
+    solvers are done in single precision without any copy (see double_operator).
+    Output:
+    E: the eigenvalues, lower bounded by eps
+    Beta: the corresponding eigenvectors
+    When only the leading eigenpairs are computed, the cumulative variance is computed with respect to the trace: for the
+    NPGPDA threshold models, whose full spectrum criterion leaves out the smallest eigenvalues, the estimated dimension may
+    then differ by one.
+    '''
+    tic = profiling.start()
+    n = K.shape[0]
+    eps = sp.finfo(sp.float64).eps
+    if solver == 'auto':
+        if d is None:
+            solver = 'full'
+        else:
+            solver = 'subset' if n <= 2000 else 'iterative'
+    if (solver != 'full') and (d is None) and (threshold is None):
+        solver = 'full'
+    
+    single = (K.dtype != sp.float64)
+    if solver == 'full':
+        E,Beta = linalg.eigh(sp.asarray(K,dtype=sp.float64))
+    else:
+        if trace is None:
+            trace = sp.trace(K,dtype=sp.float64)
+        if d is not None:
+            k = d
+        else:
+            if X0 is not None:
+                k = X0.shape[1]
+            else:
+                kn = float(sp.vdot(K,K))
+                k = max(32,int(4*trace**2/kn)) if kn > 0 else 32
+            if k > n//10:
+                k = n
+        while True:
+            k = min(max(k,1),n)
+            E = None
+            if (solver == 'lobpcg') and (5*k < n):
+                E,Beta = eig_lobpcg(K,k,X0=X0,tol=(1e-6 if single else 1e-8)*trace)
+            if E is not None:
+                X0 = Beta # Start of the next iterations in the adaptive mode
+            elif (solver == 'iterative') and (k < n-1):
+                E,Beta = eigsh(double_operator(K) if single else K,k=k,which='LA')
+            elif k == n: # Same driver as the 'full' solver
+                E,Beta = linalg.eigh(sp.asarray(K,dtype=sp.float64))
+            else:
+                try:
+                    E,Beta = linalg.eigh(sp.asarray(K,dtype=sp.float64),subset_by_index=[n-k,n-1])
+                except TypeError: # Older scipy
+                    E,Beta = linalg.eigh(sp.asarray(K,dtype=sp.float64),eigvals=(n-k,n-1))
+            # Adaptive mode: grow the subspace until the cumulative variance is reached
+            if (d is not None) or (k == n) or (sp.sum(E) > threshold*trace):
+                break
+            if (solver in ('iterative','lobpcg')) and (2*k <= n//10):
+                k *= 2
+            else:
+                k = n
 
-    del E, Beta, Ki
-    return E_,Beta_
+    idx = E.argsort()[::-1]
+    E = E[idx]
+    E[E<eps]=eps
+    Beta = Beta[:,idx]
+    profiling.stop('eig',tic)
+    profiling.event('eig',(n,E.size,solver))
+    return E,Beta
     
-def estim_d(E,threshold):
+def eig_lobpcg(K,k,X0=None,tol=1e-8,maxiter=200):
+    '''
+    Function that computes the k leading eigenpairs of a symmetric matrix with the LOBPCG iterations. The iterations
+    are started from X0, completed by random vectors: with the eigenvectors of a close matrix, only a few iterations are
+    needed.
+    Input:
+    K: the matrix of size n x n
+    k: the number of eigenpairs
+    X0: the initial vectors, of size n x k0 (optional)
+    tol: the tolerance on the norm of the residuals
+    maxiter: the maximum number of iterations
+    Output:
+    E,Beta: the eigenvalues and eigenvectors, or None,None if the iterations did not converge
+    '''
+    n = K.shape[0]
+    A = double_operator(K) if K.dtype != sp.float64 else K
+    X = sp.random.RandomState(0).randn(n,k)
+    if X0 is not None:
+        k0 = min(k,X0.shape[1])
+        X[:,0:k0] *= 1e-3/sp.sqrt(n) # Keep the initial vectors independent
+        X[:,0:k0] += X0[:,0:k0]
+    try:
+        E,Beta = lobpcg(A,X,tol=tol,maxiter=maxiter,largest=True)
+    except (linalg.LinAlgError,ValueError):
+        return None,None
+
+    # Check the convergence
+    R = A.dot(Beta)
+    R -= Beta*E
+    if sp.sqrt(sp.sum(R**2,axis=0)).max() > tol:
+        return None,None
+    return E,Beta
+
+def double_operator(K):
+    '''
+    Function that wraps a single precision matrix in a double precision linear operator, for the iterative eigen solvers:
+    the products are done in single precision, without any copy of the matrix, and the iterations in double precision.
+    '''
+    def matmat(V):
+        return sp.dot(K,sp.asarray(V,dtype=K.dtype)).astype(sp.float64)
+    return LinearOperator(K.shape,matvec=matmat,matmat=matmat,dtype=sp.float64)
+
+def estim_d(E,threshold,trace=None):
     ''' The function estimates the intrinsic dimension by looking at the cumulative variance
     Input:
         E: the eigenvalue
         threshold: the percentage of the cumulative variance
+        trace: the total variance, needed when E are only the leading eigenvalues (default: sum of E)
     Output:
         d: the intrinsic dimension
     '''
+    if trace is None:
+        trace = sp.sum(E)
     if E.size == 1:
         d=1
     else:
-        d = sp.where(sp.cumsum(E)/sp.sum(E)>threshold)[0][0]+1
+        d = sp.where(sp.cumsum(E)/trace>threshold)[0][0]+1
     return d
     
 def standardize(x,M=None,S=None,REVERSE=None):
@@ -118,6 +431,587 @@ def scale(x,M=None,m=None,REVERSE=None):
     else:
         return (1+x)/2*(M-m)+m
 
+def pack_arrays(L):
+    '''
+    The function concatenates a list of 1d or 2d arrays into a flat array, to be saved as a single block
+    Input:
+        L: the list of arrays
+    Output:
+        data: the flat array
+        shapes: the shape of each array (a 1d array of size m is stored as m x 0)
+    '''
+    shapes = sp.zeros((len(L),2),dtype=sp.int64)
+    for i,l in enumerate(L):
+        shapes[i,0] = l.shape[0]
+        if l.ndim == 2:
+            shapes[i,1] = l.shape[1]
+    data = sp.concatenate([sp.ravel(l) for l in L])
+    return data,shapes
+
+def unpack_arrays(data,shapes):
+    '''
+    The function splits a flat array into the list of arrays packed by pack_arrays. The arrays are views of data
+    Input:
+        data: the flat array
+        shapes: the shape of each array
+    Output:
+        L: the list of arrays
+    '''
+    L=[]
+    start = 0
+    for m,d in shapes:
+        if d == 0:
+            L.append(data[start:start+m])
+            start += m
+        else:
+            L.append(data[start:start+m*d].reshape(m,d))
+            start += m*d
+    return L
+
+def load_npz(filename,mmap_mode=None):
+    '''
+    The function loads the arrays stored in a npz file. If mmap_mode is given, the arrays of the (uncompressed) npz file are
+    memory-mapped instead of read, such as several processes opening the same file share its pages.
+    Input:
+        filename: the name of the file
+        mmap_mode: None, 'r', 'r+' or 'c', see numpy.memmap
+    Output:
+        data: a dictionary with the arrays
+    '''
+    data = {}
+    npz = sp.load(filename)
+    if mmap_mode is None:
+        for key in npz.files:
+            data[key]=npz[key]
+        npz.close()
+        return data
+
+    zf = zipfile.ZipFile(filename)
+    fid = open(filename,'rb')
+    for info in zf.infolist():
+        key = info.filename[:-4]
+        if info.compress_type != zipfile.ZIP_STORED:
+            data[key]=npz[key]
+            continue
+        # Find the beginning of the member: local header of 30 bytes + name + extra field
+        fid.seek(info.header_offset)
+        nl,el = struct.unpack('<HH',fid.read(30)[26:30])
+        fid.seek(info.header_offset+30+nl+el)
+        version = format.read_magic(fid)
+        if version == (1,0):
+            shape,fortran,dtype = format.read_array_header_1_0(fid)
+        else:
+            shape,fortran,dtype = format.read_array_header_2_0(fid)
+        if (len(shape) == 0) or (sp.prod(shape) == 0) or dtype.hasobject: # Scalars and empty arrays are simply read
+            data[key]=npz[key]
+        else:
+            data[key]=sp.memmap(filename,dtype=dtype,mode=mmap_mode,offset=fid.tell(),shape=shape,order='F' if fortran else 'C')
+    fid.close()
+    zf.close()
+    npz.close()
+    return data
+
+def fold_distances(x,y,it,iT):
+    '''
+    Function that computes the squared distances needed for one fold of the cross-validation
+    Input:
+    x,y: the sample matrix and the label
+    it,iT: the indices of the training and testing samples of the fold
+    Output:
+    D_: a list of the squared distances between the training samples of each class
+    DT: the squared distances between the testing samples and the training samples
+    '''
+    xt,yt = x[it,:],y[it]
+    C = int(yt.max())
+    D_ = []
+    for i in range(C):
+        t = sp.where(yt==(i+1))[0]
+        D_.append(sq_dist(xt[t,:]))
+    DT = sq_dist(x[iT,:],xt)
+    return D_,DT
+
+def score_subspaces(models,Kt,Beta_,S_,yt):
+    '''
+    Function that computes the classification error of several models learned with the fast option on the same eigen
+    decomposition. The models only differ by the number of eigenvectors kept in each class: the testing samples are
+    projected once on the leading eigenvectors of each class and the decision functions of all the models are obtained
+    from these projections.
+    Input:
+    models: a list of PGPDA or NPGPDA models learned with the fast option on a precomputed kernel
+    Kt: a KERNEL object with the kernel between the testing and the training samples, and its diagonal in Kt.kd
+    Beta_,S_: the eigenvectors and the centering statistics used to learn the models
+    yt: the label of the testing samples
+    Output:
+    err: the classification error of each model
+    '''
+    nt = Kt.K.shape[0]
+    nm = len(models)
+    C = len(Beta_)
+    D = sp.empty((nt,nm,C))
+    Ki = KERNEL()
+    kd = KERNEL()
+    
+    for i in range(C):
+        # Collect the decision function of each model
+        dm = max([model.di[i] for model in models])
+        W = sp.zeros((dm,nm))
+        ib = sp.empty(nm)
+        cst = sp.empty(nm)
+        for j,model in enumerate(models):
+            W[0:model.di[i],j] = model.w[i]
+            ib[j] = model.ib[i] if isinstance(model.ib,list) else model.ib
+            cst[j] = model.cst[i]
+
+        # Project the testing samples on the dm leading eigenvectors
+        Ki.K = Kt.K[:,models[0].t[i]]
+        kd.K = Kt.kd.copy()
+        Ki.center_kernel(kd=kd,km=S_[i][0],s=S_[i][1])
+        Q = sp.dot(Ki.K,sp.asarray(Beta_[i][:,0:dm],dtype=Ki.K.dtype))
+        Q **= 2
+        D[:,:,i] = sp.dot(Q,W)
+        D[:,:,i] += kd.K.reshape(nt,1)*ib
+        D[:,:,i] += cst
+    
+    yp = D.argmin(axis=2)+1
+    return sp.mean(yp!=sp.asarray(yt).reshape(nt,1),axis=0)
+
+def map_eigenvectors(Beta,t,tn):
+    '''
+    Function that maps eigenvectors defined on a set of samples onto a new set of samples, such as they can be used as
+    initial vectors of the 'lobpcg' solver: the values of the shared samples are kept and those of the new samples are
+    set to zero.
+    Input:
+    Beta: the eigenvectors, of size n x k
+    t,tn: the indices of the samples of Beta and of the new samples
+    Output:
+    X0: the initial vectors, of size nn x k
+    '''
+    order = sp.argsort(t)
+    pos = sp.searchsorted(t[order],tn)
+    pos[pos==t.size] = 0
+    shared = t[order[pos]]==tn
+    X0 = sp.zeros((tn.size,Beta.shape[1]))
+    X0[shared,:] = Beta[order[pos[shared]],:]
+    return X0
+
+def cv_fold(template,x,y,it,iT,sig_r,param,param_r,warm=None):
+    '''
+    Function that computes the classification errors on one fold of the cross-validation, for several values of the kernel
+    parameter and of the model parameter. The squared distances of the fold are computed once for all the values of sig.
+    Input:
+    template: an untrained model (PGPDA, NPGPDA or KDA) giving the model to be cross-validated, or a list of untrained
+              exact PGPDA/NPGPDA models sharing the kernel and the solver (e.g. several model variants)
+    x,y: the sample matrix and the label
+    it,iT: the indices of the training and testing samples of the fold
+    sig_r: the values of the kernel parameter
+    param,param_r: the name ('threshold', 'dc' or 'mu') and the values of the model parameter, or a list of names and
+                   a list of values (one per model) when template is a list
+    warm: a dictionary with the training indices and eigenvectors of each class for each value of sig, used to start the
+          'lobpcg' solver (see map_eigenvectors) and updated with those of this fold (optional)
+    Output:
+    err: the classification error for each value of sig (rows) and of the model parameter (columns). When template is
+         a list, the columns of the models are concatenated.
+    '''
+    tic = profiling.start()
+    ns = len(sig_r)
+    if isinstance(template,list):
+        templates,params,params_r = template,param,param_r
+        template = templates[0]
+        nr = sum([len(pr) for pr in params_r])
+    else:
+        templates,params,params_r = [template],[param],[param_r]
+        nr = len(param_r)
+    err = sp.zeros((ns,nr))
+    yk,yT = y[it],y[iT]
+
+    if isinstance(template,KDA):
+        D = sq_dist(x[it,:])
+        DT = sq_dist(x[iT,:],x[it,:])
+        K,Kt = KERNEL(),KERNEL()
+        for i in range(ns):
+            K.compute_kernel_from_dist(D,sig_r[i])
+            Kt.compute_kernel_from_dist(DT,sig_r[i])
+            for j in range(nr):
+                model_temp=KDA(rank=template.rank)
+                model_temp.precomputed = 1
+                model_temp.train(K,yk,sig=sig_r[i],mu=param_r[j])
+                yp = model_temp.predict(Kt,None,yk)
+                yp.shape = yT.shape
+                t = sp.where(yp!=yT)[0]
+                err[i,j] = float(t.size)/yp.size
+                del model_temp
+    elif template.approx is not None:
+        # The approximated models are learned for each value of the parameters, in the feature space of the landmarks
+        xk,xT = x[it,:],x[iT,:]
+        for i in range(ns):
+            for j in range(nr):
+                model_temp = template.__class__(model=template.model,kernel=template.kernel,solver=template.solver,
+                                                approx=template.approx,m=template.m,sampling=template.sampling)
+                model_temp.train(xk,yk,sig=sig_r[i],**{param:param_r[j]})
+                yp = model_temp.predict(xT)
+                yp.shape = yT.shape
+                err[i,j] = sp.mean(yp!=yT)
+                del model_temp
+    else:
+        D_,DT = fold_distances(x,y,it,iT)
+        Kt = KERNEL()
+        # Only the leading eigenpairs needed by the parameters are computed with a partial solver, all of them if both
+        # dc and threshold models are cross-validated
+        d,threshold,solver = None,None,template.solver
+        if 'dc' in params:
+            d = int(max([max(pr) for p,pr in zip(params,params_r) if p == 'dc']))
+        if 'threshold' in params:
+            threshold = max([max(pr) for p,pr in zip(params,params_r) if p == 'threshold'])
+        if (d is not None) and (threshold is not None):
+            d,threshold,solver = None,None,'full'
+        if warm is not None:
+            tk = sp.asarray(it)
+            tk = [tk[sp.where(yk==(c+1))[0]] for c in range(len(D_))]
+        for i in range(ns):
+            # Precompute the E and Beta, starting from the eigenvectors of the previous fold
+            X0_ = None
+            if (warm is not None) and (sig_r[i] in warm):
+                tp,Bp = warm[sig_r[i]]
+                X0_ = [map_eigenvectors(Bp[c],tp[c],tk[c]) for c in range(len(D_))]
+            E_,Beta_,S_=pre_compute_E_Beta(None,yk,sig_r[i],kernel=template.kernel,D_=D_,solver=solver,d=d,threshold=threshold,X0_=X0_)
+            if warm is not None:
+                warm[sig_r[i]] = (tk,Beta_)
+            Kt.compute_kernel_from_dist(DT,sig_r[i],kernel=template.kernel)
+            Kt.kd = sp.ones((DT.shape[0],1))
+            # Learn the models for all the values of the parameter: only the eigenvalues are used
+            models = []
+            for tp,p,pr in zip(templates,params,params_r):
+                for j in range(len(pr)):
+                    model_temp = tp.__class__(model=tp.model,kernel=tp.kernel,solver=tp.solver)
+                    model_temp.precomputed = 1
+                    kwargs = {p:pr[j]}
+                    model_temp.train(None,yk,sig=sig_r[i],fast=1,E_=E_,Beta_=Beta_,S_=S_,**kwargs)
+                    models.append(model_temp)
+            # Project the testing samples once and score all the models
+            err[i,:] = score_subspaces(models,Kt,Beta_,S_,yT)
+            del models
+    profiling.stop('cv_fold',tic)
+    return err
+
+def cv_folds(template,x,y,folds,sig_r,param,param_r):
+    '''
+    Function that computes the sum of the classification errors over several folds, see cv_fold. With the 'lobpcg'
+    solver, the eigen decompositions of each fold are started from the eigenvectors of the previous fold, the training
+    sets of the folds sharing most of their samples.
+    Input:
+    folds: a list of the indices (it,iT) of the training and testing samples of each fold
+    the other parameters: see cv_fold
+    Output:
+    err: the sum of the classification errors
+    '''
+    t = template[0] if isinstance(template,list) else template
+    warm = {} if getattr(t,'solver',None) == 'lobpcg' else None
+    err = 0
+    for it,iT in folds:
+        err = err + cv_fold(template,x,y,it,iT,sig_r,param,param_r,warm=warm)
+    return err
+
+def cv_worker(args):
+    '''
+    Function run by the processes of the parallel cross-validation: the sample matrix is memory-mapped from a file
+    '''
+    filename = args[0]
+    x = sp.load(filename,mmap_mode='r')
+    return cv_folds(args[1],x,*args[2:])
+
+def run_cross_validation(template,x,y,cv,sig_r,param,param_r,n_jobs=1):
+    '''
+    Function that runs the cross-validation over the folds, the values of the kernel parameter and of the model parameter.
+    With several processes, the work is split in units (one fold, a subset of the values of sig) and the sample matrix is
+    shared through a memory-mapped file rather than sent to each process. With the 'lobpcg' solver, a unit is a subset of
+    the values of sig for all the folds, such as the folds are warm-started (see cv_folds).
+    Input:
+    template: an untrained model (PGPDA, NPGPDA or KDA) giving the model to be cross-validated, or a list of models
+              (see cv_fold)
+    x,y: the sample matrix and the label
+    cv: a CV object with the indices of the folds
+    sig_r: the values of the kernel parameter
+    param,param_r: the name ('threshold', 'dc' or 'mu') and the values of the model parameter, or lists (see cv_fold)
+    n_jobs: the number of processes, -1 for all the cpus. The number of BLAS threads of each process is limited to
+            cpu_count/n_jobs (see limit_blas_threads).
+    Output:
+    err: the mean classification error over the folds
+    '''
+    tic = profiling.start()
+    v = len(cv.it)
+    ns = sig_r.size
+    if isinstance(template,list):
+        err = sp.zeros((ns,sum([pr.size for pr in param_r])))
+    else:
+        err = sp.zeros((ns,param_r.size))
+    if n_jobs == -1:
+        n_jobs = mp.cpu_count()
+
+    folds = zip(cv.it,cv.iT)
+    t = template[0] if isinstance(template,list) else template
+    if getattr(t,'solver',None) == 'lobpcg': # The folds are processed in sequence
+        folds = [folds]
+    else:
+        folds = [[f] for f in folds]
+
+    if n_jobs == 1:
+        for f in folds:
+            err += cv_folds(template,x,y,f,sig_r,param,param_r)
+    else:
+        # Split the values of sig such as there are enough units for all the processes
+        nc = min(ns,int(sp.ceil(float(n_jobs)/len(folds))))
+        chunks = sp.array_split(sp.arange(ns),nc)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir,'x.npy')
+            sp.save(filename,x)
+            units,index = [],[]
+            for f in folds:
+                for c in chunks:
+                    units.append((filename,template,y,f,sig_r[c],param,param_r))
+                    index.append(c)
+            npool = min(n_jobs,len(units))
+            warn_blas_threads()
+            pool = mp.Pool(npool,initializer=limit_blas_threads,initargs=(max(1,mp.cpu_count()//npool),))
+            try:
+                res = pool.map(cv_worker,units)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(tmpdir)
+        for c,e in zip(index,res):
+            err[c,:] += e
+    err/=v
+    profiling.stop('run_cross_validation',tic)
+    return err
+
+def search_halving(template,x,y,cv,sig_r,param,param_r,n_jobs=1,eta=3,refine=2):
+    '''
+    Function that selects the parameters by successive halving over the values of the kernel parameter, followed by a
+    refinement of sig on a log scale. All the values of sig are first evaluated on one fold, the 1/eta best ones are
+    evaluated on eta times more folds, and so on until all the folds are used. Values of sig between the best one and
+    its neighbours (in log scale) are then evaluated on all the folds, the step being halved at each refinement. All the
+    values of the model parameter are evaluated for each value of sig, see cv_fold.
+    Input:
+    template,x,y,cv,sig_r,param,param_r,n_jobs: see run_cross_validation
+    eta: the fraction 1/eta of the values of sig kept after each round, and the growth factor of the number of folds
+    refine: the number of refinement steps
+    Output:
+    sig,p: the selected kernel parameter and model parameter
+    err: the mean classification error over the folds used to evaluate each value of sig_r (rows) and of the model
+         parameter (columns)
+    trace: a list of the evaluations (sig, number of folds, minimum error over the model parameter), in order
+    '''
+    v = len(cv.it)
+    ns = sig_r.size
+    err = sp.zeros((ns,param_r.size))
+    trace = []
+
+    # Successive halving on the folds
+    alive = sp.arange(ns)
+    f0,f1 = 0,1
+    while True:
+        sub = CV()
+        sub.it,sub.iT = cv.it[f0:f1],cv.iT[f0:f1]
+        e = run_cross_validation(template,x,y,sub,sig_r[alive],param,param_r,n_jobs=n_jobs)
+        err[alive,:] = (err[alive,:]*f0+e*(f1-f0))/f1
+        for i in alive:
+            trace.append((sig_r[i],f1,err[i,:].min()))
+        if f1 == v:
+            break
+        order = sp.argsort(err[alive,:].min(axis=1),kind='mergesort')
+        alive = sp.sort(alive[order[0:int(sp.ceil(float(alive.size)/eta))]])
+        f0,f1 = f1,min(v,f1*eta)
+
+    t = sp.where(err[alive,:]==err[alive,:].min())
+    sig,p,e_min = sig_r[alive[t[0][0]]],param_r[t[1][0]],err[alive,:].min()
+
+    # Refinement of sig on a log scale around the best value
+    ls = sp.unique(sp.log(sig_r))
+    step = sp.diff(ls).min()/2 if ls.size > 1 else sp.log(2.0)/2
+    for r in range(refine):
+        sig_c = sig*sp.exp(sp.array([-step,step]))
+        e = run_cross_validation(template,x,y,cv,sig_c,param,param_r,n_jobs=n_jobs)
+        for i in range(sig_c.size):
+            trace.append((sig_c[i],v,e[i,:].min()))
+        if e.min() < e_min:
+            t = sp.where(e==e.min())
+            sig,p,e_min = sig_c[t[0][0]],param_r[t[1][0]],e.min()
+        step /= 2
+    return sig,p,err,trace
+
+def make_model(name,**kwargs):
+    '''
+    Function that creates an untrained PGPDA (models M0 to M6) or NPGPDA (models NM0 to NM4) model
+    Input:
+    name: the name of the model
+    kwargs: the other parameters of the model (kernel, sig, dc, threshold, solver, ...)
+    Output:
+    model: the untrained model
+    '''
+    if name.startswith('N'):
+        return NPGPDA(model=name,**kwargs)
+    else:
+        return PGPDA(model=name,**kwargs)
+
+def train_models(x,y,models=MODELS,kernel='RBF',sig=0.5,dc=2,threshold=0.95,solver='full',n_jobs=1,parallel='thread'):
+    '''
+    Function that trains several parsimonious models (e.g. all the model variants) on the same samples with one kernel
+    eigen decomposition per class. The models only differ by the way a, b and di are derived from the eigenpairs: they
+    share the eigenvectors (each model has a view on the di leading ones) and the support vectors.
+    Input:
+    x,y: the sample matrix and the label
+    models: the names of the models, see make_model
+    kernel,sig,dc,threshold,solver: the parameters of the models. With a partial solver, all the eigenpairs are computed
+                                    if both dc and threshold models are trained.
+    n_jobs,parallel: the number of classes processed in parallel and the kind of workers, see map_classes
+    Output:
+    models: the list of trained models
+    '''
+    models = [make_model(name,kernel=kernel,sig=sig,dc=dc,threshold=threshold,solver=solver) for name in models]
+    C = int(y.max())
+
+    # Eigen decomposition of each class, only the leading eigenpairs needed by the models with a partial solver
+    d,thrs = None,None
+    if any([model.model in MODELS_DC for model in models]):
+        d = dc
+    if any([model.model not in MODELS_DC for model in models]):
+        thrs = threshold
+    if (d is not None) and (thrs is not None):
+        d,thrs,solver = None,None,'full'
+    E_,Beta_,S_ = pre_compute_E_Beta(x,y,sig,kernel=kernel,solver=solver,d=d,threshold=thrs,n_jobs=n_jobs,parallel=parallel)
+
+    for model in models:
+        model.train(x,y,fast=1,E_=E_,Beta_=Beta_,S_=S_)
+        if model is not models[0]:
+            model.X,model.norms = models[0].X,models[0].norms
+
+    # Keep only the eigenvectors used by the models
+    for i in range(C):
+        Beta = Beta_[i][:,0:max([model.di[i] for model in models])].copy()
+        for model in models:
+            model.Beta[i] = Beta[:,0:model.di[i]]
+    del E_,Beta_,S_
+    return models
+
+def cross_validation_models(x,y,models=MODELS,v=5,sig_r=2.0**sp.arange(-8,0),threshold_r=sp.linspace(0.85,0.9999,10),dc_r=sp.arange(5,50),kernel='RBF',solver='full',n_jobs=1):
+    '''
+    Function that selects the parameters of several parsimonious models (e.g. all the model variants) by v-fold
+    cross-validation, in a single pass: on each fold and for each value of sig, the eigen decomposition and the projection
+    of the testing samples are shared by all the models and all the values of the model parameters.
+    Input:
+    x,y: the sample matrix and the label
+    models: the names of the models, see make_model
+    v: the number of folds
+    sig_r: the values of the kernel parameter
+    threshold_r,dc_r: the values of the threshold or of dc, depending on the model
+    kernel,solver: the kernel and the eigen solver
+    n_jobs: the number of processes used to run the folds and the values of sig in parallel, -1 for all the cpus
+    Output:
+    results: a list with, for each model, the selected kernel parameter, the selected threshold or dc and the
+             classification error for each value of sig and of the model parameter
+    '''
+    cv = CV()
+    cv.split_data_class(y,v=v)
+    templates = [make_model(name,kernel=kernel,solver=solver) for name in models]
+    params = ['dc' if name in MODELS_DC else 'threshold' for name in models]
+    params_r = [dc_r if p == 'dc' else threshold_r for p in params]
+
+    err = run_cross_validation(templates,x,y,cv,sig_r,params,params_r,n_jobs=n_jobs)
+
+    results = []
+    start = 0
+    for pr in params_r:
+        e = err[:,start:start+pr.size]
+        start += pr.size
+        t = sp.where(e==e.min())
+        results.append((sig_r[t[0][0]],pr[t[1][0]],e))
+    return results
+
+def image_blocks(im,block_size):
+    '''
+    Function that splits an image, or a matrix of samples, in blocks of at most block_size samples. The blocks follow
+    the rows of the image, such as only the current block is read from a memory-mapped image.
+    Input:
+    im: the image (rows x cols x bands) or the sample matrix (n x bands)
+    block_size: the maximum number of samples per block
+    Output:
+    a generator of (start,x): the index of the first sample of the block and the block (m x bands)
+    '''
+    d = im.shape[-1]
+    if im.ndim == 2:
+        for start in range(0,im.shape[0],block_size):
+            yield start,im[start:start+block_size,:]
+    else:
+        rows,cols = im.shape[0],im.shape[1]
+        if block_size >= cols:
+            nr = block_size//cols
+            for r in range(0,rows,nr):
+                yield r*cols,im[r:r+nr,:,:].reshape(-1,d)
+        else:
+            for r in range(rows):
+                for c in range(0,cols,block_size):
+                    yield r*cols+c,im[r,c:c+block_size,:]
+
+def predict_image(model,im,max_memory=None,labels=None,decisions=None,probas=None):
+    '''
+    Function that classifies a whole image, or a stream of samples, by blocks whose size is derived from a memory budget.
+    The results are written in the outputs, which can be pre-allocated or memory-mapped arrays.
+    Input:
+    model: a learned PGPDA or NPGPDA model
+    im: the image (rows x cols x bands, possibly memory-mapped), a sample matrix (n x bands), or an iterator over
+        blocks of samples (m x bands)
+    max_memory: the memory budget in bytes of the kernel matrices of one block, default kernels.MAX_MEMORY
+    labels: the output labels, of size rows x cols or n. Allocated if None.
+    decisions,probas: the output decision functions and posterior probabilities, of size rows x cols x C or n x C.
+        They are only computed if given. The decision functions are not shifted (see predict), so they do not depend on
+        the blocks, i.e. on max_memory.
+    Output:
+    labels, or labels,decisions,probas if decisions or probas are given
+    '''
+    C = len(model.ni)
+    n = model.X.shape[0] if model.X is not None else 2*model.M[0].shape[1] # Random features and their centered copy
+    stream = not isinstance(im,sp.ndarray)
+    if stream:
+        blocks = im
+        collect = []
+    else:
+        if labels is None:
+            labels = sp.empty(im.shape[:-1],dtype=sp.uint16)
+        blocks = [im]
+        
+    start = 0
+    for block in blocks:
+        block_size = get_block_size(n+3*C,block.shape[-1],max_memory)
+        for offset,xb in image_blocks(block,block_size):
+            xb = sp.asarray(xb,dtype=sp.float64)
+            m = xb.shape[0]
+            if probas is not None:
+                yp,D,P = model.predict(xb,out_decision=1,out_proba=1,shift=False)
+            elif decisions is not None:
+                yp,D = model.predict(xb,out_decision=1,shift=False)
+            else:
+                yp = model.predict(xb)
+
+            # Write the outputs of the block
+            if stream and (labels is None):
+                collect.append(yp.ravel().astype(sp.uint16))
+            else:
+                labels.flat[start+offset:start+offset+m] = yp.ravel()
+            if decisions is not None:
+                decisions.flat[(start+offset)*C:(start+offset+m)*C] = D.ravel()
+            if probas is not None:
+                probas.flat[(start+offset)*C:(start+offset+m)*C] = P.ravel()
+        start += sp.prod(block.shape[:-1])
+    if stream and (labels is None):
+        labels = sp.concatenate(collect)
+
+    if (decisions is None) and (probas is None):
+        return labels
+    else:
+        return labels,decisions,probas
+
 class CV:
     '''
     This class implements the generation of several folds to be used in the cross validation
@@ -196,24 +1090,38 @@ class CV:
             self.iT.append(tempiT)
 
 class PGPDA: # Parcimonious Gaussian Process Discriminant Analysis
-    def __init__(self,model='M0',kernel='RBF',sig=None,dc=None,threshold=None):
+    def __init__(self,model='M0',kernel='RBF',sig=None,dc=None,threshold=None,solver='full',approx=None,m=100,sampling='uniform'):
         self.model=model
         self.kernel=kernel
+        self.solver=solver
+        self.approx=approx
+        self.m=m
+        self.sampling=sampling
         self.sig=sig
         self.dc=dc
         self.threshold=threshold
-        self.A=[]
+        self.w=[]
+        self.cst=[]
         self.Beta=[]
         self.b = 0.0
         self.ib = 0.0
         self.a = []
+        self.E = []
+        self.trace = []
         self.prop = []
         self.ni= []
         self.di = []
         self.ri = []
+        self.km = []
+        self.s = []
+        self.X = None
+        self.norms = None
+        self.idx = None
+        self.t = []
+        self.M = []
         self.precomputed = None
         
-    def train(self,x,y,sig=None,dc=None,threshold=None,fast=None,E_=None,Beta_=None):
+    def train(self,x,y,sig=None,dc=None,threshold=None,fast=None,E_=None,Beta_=None,S_=None,n_jobs=1,parallel='thread'):
         '''
         The function trains the pgpda model using the training samples
         Inputs:
@@ -223,10 +1131,19 @@ class PGPDA: # Parcimonious Gaussian Process Discriminant Analysis
         dc: the number of dimension of the singanl subspace
         threshold: the value of the cummulative variance that should be reached
         fast = option used to perform a fast CV: only the parameter dc/threshold is learn
+        E_,Beta_,S_: the pre computed eigenvalues, eigenvectors and centering statistics (fast option)
+        n_jobs: the number of classes processed in parallel, -1 for all the cpus
+        parallel: 'thread' or 'process', see map_classes
+        The eigen solver is given by self.solver, see eig_kernel
+        With self.approx='nystrom', the kernel of each class is approximated from self.m landmarks selected with
+        self.sampling (see select_landmarks), and the model is learned in the feature space of the landmarks.
+        With self.approx='rff' (RBF kernel), the model is learned in the space of self.m random Fourier features shared
+        by all the classes (see rff_map): the prediction cost does not depend on the number of training samples.
         
         Outputs:
         None - The model is included/updated in the object
         '''
+        tic = profiling.start()
         # Initialization
         n = y.shape[0]
         C = int(y.max())
@@ -252,51 +1169,124 @@ class PGPDA: # Parcimonious Gaussian Process Discriminant Analysis
         if (list_model_dc.find(self.model) > -1): 
             for i in range(C):
                 ni = sp.size(sp.where(y==(i+1))[0])
+                if self.approx is not None:
+                    ni = min(ni,self.m)
                 if self.dc > ni:
                     self.dc=ni-1
         
+        # Eigen decomposition of the kernel of each class, the classes are processed in parallel if n_jobs > 1
+        if fast is None:
+            if list_model_dc.find(self.model) == -1:
+                d,thrs = None,self.threshold
+            else:
+                d,thrs = self.dc,None
+            if self.approx == 'nystrom':
+                if self.precomputed is not None:
+                    raise ValueError('The Nystrom approximation can not be used with a precomputed kernel')
+                units = ((x[sp.where(y==(i+1))[0],:],self.kernel,self.sig,self.m,self.sampling,i,self.solver,d,thrs) for i in range(C))
+                res = map_classes(class_eigen_nystrom,units,n_jobs=n_jobs,parallel=parallel)
+            elif self.approx == 'rff':
+                if (self.precomputed is not None) or (self.kernel != 'RBF'):
+                    raise ValueError('The random Fourier features need the samples and the RBF kernel')
+                W,phase = rff_map(x.shape[1],self.m,self.sig)
+                self.M = [W,phase]
+                units = ((x[sp.where(y==(i+1))[0],:],W,phase,self.solver,d,thrs) for i in range(C))
+                res = map_classes(class_eigen_rff,units,n_jobs=n_jobs,parallel=parallel)
+            elif self.approx is not None:
+                raise ValueError('Unknown approximation '+str(self.approx)+', available approximations: nystrom, rff')
+            else:
+                if self.precomputed is None:
+                    units = ((x[sp.where(y==(i+1))[0],:],None,None,self.kernel,self.sig,self.solver,d,thrs) for i in range(C))
+                else:
+                    units = ((None,x.K[sp.ix_(sp.where(y==(i+1))[0],sp.where(y==(i+1))[0])],None,self.kernel,self.sig,self.solver,d,thrs) for i in range(C))
+                res = map_classes(class_eigen,units,n_jobs=n_jobs,parallel=parallel)
+            landmarks = []
+
         for i in range(C):
             t = sp.where(y==(i+1))[0]
             self.ni.append(sp.size(t))
             self.prop.append(float(self.ni[i])/n)
 
+            if self.precomputed is not None:
+                self.t.append(t)
+
             if fast is None:
-                # Compute Mi
-                Ki= KERNEL()
-                if self.precomputed is None:
-                    Ki.compute_kernel(x[t,:],kernel=self.kernel,sig=self.sig)                
-                else:
-                    Ki.K = x.K[t,:][:,t].copy()
-                    Ki.rank = Ki.K.shape[0]
-                    
-                self.ri.append(Ki.rank)
-                Ki.center_kernel()
-                Ki.scale_kernel(self.ni[i])
-                TraceKi = sp.trace(Ki.K)
-            
-                # Eigenvalue decomposition  
-                E,Beta = linalg.eigh(Ki.K)
-                idx = E.argsort()[::-1]
-                E = E[idx]
-                E[E<eps]=eps
-                Beta = Beta[:,idx]
+                E,Beta,S,rank = next(res)
+                self.ri.append(rank)
+                self.km.append(S[0])
+                self.s.append(S[1])
+                TraceKi = S[2]
+                if self.approx == 'nystrom':
+                    landmarks.append(S[3])
+                    self.M.append(S[4])
             else:
                 E=E_[i]
                 Beta=Beta_[i]
-                self.ri.append(E.size)
-                TraceKi = sp.sum(E)
+                self.ri.append(Beta.shape[0])
+                self.km.append(S_[i][0])
+                self.s.append(S_[i][1])
+                TraceKi = S_[i][2]
             
             # Parameter estimation
-            if list_model_dc.find(self.model) == -1:
-                di = estim_d(E[0:self.ri[i]],self.threshold)
-            else:
-                di = self.dc
+            di = self.estimate_dimension(E,Beta,TraceKi,self.ri[i])
             self.di.append(di)
-            self.a.append(E[0:di])
-            self.b += self.prop[i]*(TraceKi-sp.sum(self.a[i]))
-            self.Beta.append(Beta[:,0:di])
+            self.E.append(E[0:di].copy())
+            self.trace.append(TraceKi)
+            if fast is None:
+                self.Beta.append(Beta[:,0:di].copy()) # Copy to release the full eigenvector matrix
+            else:
+                self.Beta.append(Beta[:,0:di]) # View on the shared pre computed eigenvectors
             del Beta,E
+        if fast is None:
+            res.close() # Release the workers
             
+        # Store the support vectors (the landmarks with the Nystrom approximation, none with the random features), ordered by class
+        if self.approx is None:
+            self.idx = sp.concatenate(([0],sp.cumsum(self.ni)))
+            if self.precomputed is None:
+                self.X = sp.empty((n,x.shape[1]))
+                for i in range(C):
+                    self.X[self.idx[i]:self.idx[i+1],:] = x[sp.where(y==(i+1))[0],:]
+        elif self.approx == 'nystrom':
+            self.idx = sp.concatenate(([0],sp.cumsum([l.shape[0] for l in landmarks])))
+            self.X = sp.concatenate(landmarks)
+            del landmarks
+        if self.X is not None:
+            self.norms = sq_norms(self.X)
+        self.estimate_parameters()
+        profiling.stop(self.__class__.__name__+'.train',tic,samples=n)
+
+    def estimate_dimension(self,E,Beta,trace,ri):
+        '''
+        The function estimates the dimension of the signal subspace of a class
+        Input:
+            E,Beta: the eigenvalues and eigenvectors of the centered scaled kernel of the class
+            trace: the trace of the centered scaled kernel
+            ri: the rank of the class
+        Output:
+            di: the dimension
+        '''
+        if self.model in MODELS_DC:
+            return self.dc
+        elif E.size == Beta.shape[0]: # The full spectrum is available
+            return estim_d(E[0:ri],self.threshold)
+        else: # Only the leading eigenvalues are available
+            return estim_d(E,self.threshold,trace=trace)
+
+    def estimate_parameters(self):
+        '''
+        The function derives the parameters of the model from the leading eigenvalues, the trace and the dimension of the
+        signal subspace of each class: the noise b, the eigenvalues a of the model and the decision function. It is the
+        last step of train and update.
+        '''
+        tic = profiling.start()
+        C = len(self.ni)
+        eps = sp.finfo(sp.float64).eps
+        self.a = [E.copy() for E in self.E]
+        self.b = 0.0
+        for i in range(C):
+            self.b += self.prop[i]*(self.trace[i]-sp.sum(self.a[i]))
+
         # Last step for the safe estimation of 'b'
         denom = sum(map(lambda p,r,d:p*(r-d),self.prop,self.ri,self.di)) 
         
@@ -311,19 +1301,10 @@ class PGPDA: # Parcimonious Gaussian Process Discriminant Analysis
             self.b /=denom
         
         # Finish the estimation for the different models
-        if self.model == 'M0' or self.model == 'M1':
-            for i in range(C):
-                # Compute the value of matrix A
-                temp =self.Beta[i]*((1/self.a[i]-self.ib)/self.a[i]).reshape(self.di[i])
-                self.A.append(sp.dot(temp,self.Beta[i].T)/self.ni[i])
-
-        elif self.model == 'M2' or self.model == 'M3':
+        if self.model == 'M2' or self.model == 'M3':
             for i in range(C):
                 # Update the value of a
                 self.a[i][:]=sp.mean(self.a[i])
-                # Compute the value of matrix A
-                temp =self.Beta[i]*((1/self.a[i]-self.ib)/self.a[i]).reshape(self.di[i])
-                self.A.append(sp.dot(temp,self.Beta[i].T)/self.ni[i])
 
         elif self.model == 'M4': 
             # Compute the value of a
@@ -333,8 +1314,6 @@ class PGPDA: # Parcimonious Gaussian Process Discriminant Analysis
                     al[i] += self.prop[j]*self.a[j][i]
             for i in range(C):
                 self.a[i]=al.copy()
-                temp =self.Beta[i]*((1/self.a[i]-self.ib)/self.a[i]).reshape(self.di[i])
-                self.A.append(sp.dot(temp,self.Beta[i].T)/self.ni[i])
 
         elif self.model == 'M5' or self.model=='M6':
             num = sum(map(lambda p,a:p*sum(a),self.prop,self.a))
@@ -342,24 +1321,101 @@ class PGPDA: # Parcimonious Gaussian Process Discriminant Analysis
             ac = num/den
             for i in range(C):
                 self.a[i][:]=ac
-                temp =self.Beta[i]*((1/self.a[i]-self.ib)/self.a[i]).reshape(self.di[i])
-                self.A.append(sp.dot(temp,self.Beta[i].T)/self.ni[i])
-                
-        self.A = sp.asarray(self.A)   
 
-       
-    def predict(self,xt,x,y,out_decision=None,out_proba=None):
+        # Compute the weights of the low rank decision function: A = Beta diag(w) Beta^T is never formed
+        dm = max(self.di)
+        self.w,self.cst = [],[]
+        for i in range(C):
+            self.w.append((1/self.a[i]-self.ib)/self.a[i]/self.ni[i])
+            self.cst.append(sp.sum(sp.log(self.a[i])) + (dm-self.di[i])*sp.log(self.b) -2*sp.log(self.prop[i]))
+        profiling.stop('estimate',tic)
+
+    def update(self,x_new,y_new,n_jobs=1,parallel='thread'):
+        '''
+        The function updates the learned model with new samples, of the learned classes or of new classes (labeled C+1,
+        C+2, ...). Only the classes with new samples are learned again, from their support vectors and their new samples.
+        With the 'lobpcg' solver, their eigen decomposition is started from the current eigenvectors. The parameters
+        shared by the classes are then derived again, see estimate_parameters.
+        Input:
+            x_new,y_new: the new samples and their label
+            n_jobs,parallel: the number of classes processed in parallel and the kind of workers, see map_classes
+        Output:
+            None - The model is updated in the object
+        '''
+        tic = profiling.start()
+        if (self.approx is not None) or (self.X is None):
+            raise ValueError('Only the exact models learned on the samples can be updated')
+        y_new = sp.asarray(y_new).ravel()
+        C = len(self.ni)
+        classes = sp.unique(y_new).astype(int)
+        if (classes.min() < 1) or (set(range(C+1,classes.max()+1))-set(classes)):
+            raise ValueError('The labels of the new classes must follow the labels of the learned classes')
+        if self.model in MODELS_DC:
+            d,thrs = self.dc,None
+        else:
+            d,thrs = None,self.threshold
+
+        # Samples of the classes to learn again, started from the current eigenvectors with the 'lobpcg' solver
+        xs = [self.X[self.idx[i]:self.idx[i+1],:] for i in range(C)]
+        units = []
+        for c in classes:
+            t = sp.where(y_new==c)[0]
+            X0 = None
+            if c <= C:
+                xs[c-1] = sp.concatenate((xs[c-1],x_new[t,:]))
+                if self.solver == 'lobpcg':
+                    X0 = sp.concatenate((self.Beta[c-1],sp.zeros((t.size,self.di[c-1]))))
+            else:
+                xs.append(x_new[t,:])
+            # Check of consistent dimension
+            if (self.model in MODELS_DC) and (self.dc > xs[c-1].shape[0]):
+                self.dc = xs[c-1].shape[0]-1
+            units.append((xs[c-1],None,None,self.kernel,self.sig,self.solver,d,thrs,X0))
+
+        for c,(E,Beta,S,rank) in zip(classes,map_classes(class_eigen,units,n_jobs=n_jobs,parallel=parallel)):
+            i = c-1
+            if i == len(self.ni): # New class
+                for l in (self.ni,self.ri,self.km,self.s,self.trace,self.di,self.E,self.Beta):
+                    l.append(None)
+            self.ni[i] = Beta.shape[0]
+            self.ri[i] = rank
+            self.km[i],self.s[i],self.trace[i] = S
+            self.di[i] = self.estimate_dimension(E,Beta,S[2],self.ri[i])
+            self.E[i] = E[0:self.di[i]].copy()
+            self.Beta[i] = Beta[:,0:self.di[i]].copy()
+            del E,Beta
+
+        # The dimension of the models with a common dc can only decrease
+        if self.model in MODELS_DC:
+            for i in range(len(self.ni)):
+                self.di[i] = self.dc
+                self.E[i] = self.E[i][0:self.dc]
+                self.Beta[i] = self.Beta[i][:,0:self.dc]
+
+        # Support vectors and proportions
+        n = sum(self.ni)
+        self.prop = [float(ni)/n for ni in self.ni]
+        self.idx = sp.concatenate(([0],sp.cumsum(self.ni)))
+        self.X = sp.concatenate(xs)
+        self.norms = sq_norms(self.X)
+        del xs,units
+        self.estimate_parameters()
+        profiling.stop(self.__class__.__name__+'.update',tic,samples=n)
+
+    def predict(self,xt,x=None,y=None,out_decision=None,out_proba=None,shift=True):
         '''
         The function predicts the label for each sample with the learned model
         Input:
-            xt: the test samples
-            x: the samples matrix of size n x d
-            y: the vector with label of size n
+            xt: the test samples, for the precomputed case, xt is a KERNEL object
+            x,y: not used, kept for compatibility. The model stores its own support vectors (or landmarks).
+            shift: if True, the decision functions are shifted such as their minimum over the test samples is zero
+                   (if negative). The labels and the posterior probabilities do not depend on it.
         Output
             yp: the label
             D: the discriminant function
             P: the posterior probabilities
         '''
+        tic = profiling.start()
          
         # Initialization
         if isinstance(xt,sp.ndarray):
@@ -367,37 +1423,50 @@ class PGPDA: # Parcimonious Gaussian Process Discriminant Analysis
         else:
             nt = xt.K.shape[0]
             
-        C = int(y.max())
+        C = len(self.ni)
         eps = sp.finfo(sp.float64).eps
-        dm = max(self.di)
 
         D = sp.empty((nt,C))
-        Ki = KERNEL()
         Kt = KERNEL()
         kd = KERNEL()
+
+        # Kernel between the test samples and all the support vectors (ordered by class), or random features, computed once
+        if self.precomputed is None:
+            K = KERNEL()
+            if self.approx == 'rff':
+                K.compute_rff(xt,self.M[0],self.M[1])
+            else:
+                K.compute_kernel(xt,z=self.X,kernel=self.kernel,sig=self.sig,norms=self.norms)
         
         for i in range(C):
-            t = sp.where(y==(i+1))[0]
-            cst = sp.sum(sp.log(self.a[i])) + (dm-self.di[i])*sp.log(self.b) -2*sp.log(self.prop[i]) 
             if self.precomputed is None:
-                Ki.compute_kernel(x[t,:],kernel=self.kernel,sig=self.sig)
-                Kt.compute_kernel(xt,z=x[t,:],kernel=self.kernel,sig=self.sig)
+                if self.approx == 'rff':
+                    Kt.K = K.K.copy()
+                else:
+                    Kt.K = K.K[:,self.idx[i]:self.idx[i+1]]
                 kd.compute_diag_kernel(xt,kernel=self.kernel,sig=self.sig)
             else:
-                Ki.K= x.K[t,:][:,t].copy()
-                Kt.K= xt.K[:,t].copy()
+                Kt.K= xt.K[:,self.t[i]].copy()
                 kd.K= xt.kd.copy()
-            Kt.center_kernel(Ko=Ki, kd=kd)
-            Ki.K=None
+            if self.approx is None:
+                Kt.center_kernel(kd=kd,km=self.km[i],s=self.s[i])
+            else: # Features of the testing samples, the decision rule is unchanged
+                if self.approx == 'nystrom':
+                    Kt.K = sp.dot(Kt.K,sp.asarray(self.M[i],dtype=Kt.K.dtype))
+                Kt.center_features(kd=kd,mu=self.km[i])
 
-            #Compute the decision rule
-            temp = sp.dot(Kt.K,self.A[i])
-            D[:,i] = sp.sum(Kt.K*temp,axis=1)
-            D[:,i] += kd.K*self.ib+cst           
+            #Compute the decision rule: sum_j w_j*(Kt*beta_j)^2, in O(nt*ni*di), in the type of the kernel
+            temp = sp.dot(Kt.K,sp.asarray(self.Beta[i],dtype=Kt.K.dtype))
+            temp **= 2
+            D[:,i] = sp.dot(temp,self.w[i])
+            D[:,i] += kd.K*self.ib+self.cst[i]           
+        profiling.stop(self.__class__.__name__+'.predict',tic,samples=nt)
             
         # Check if negative value
-        if D.min() <0:
-            D-=D.min()
+        Dmin = min(D.min(),0)
+        if shift:
+            D-=Dmin
+            Dmin = 0
         
         yp = D.argmin(1)+1
         yp.shape=(nt,1)
@@ -410,89 +1479,163 @@ class PGPDA: # Parcimonious Gaussian Process Discriminant Analysis
                 return yp,D
         else:        
             # Compute posterior !! Should be changed to a safe version
-            P = sp.exp(-0.5*D)
+            P = sp.exp(-0.5*(D-Dmin))
             P /= sp.sum(P,axis=1).reshape(nt,1)
             P[P<eps]=0                    
         return yp,D,P
+
+    def save(self,filename):
+        '''
+        The function saves the learned model in an uncompressed npz file. The saved model is self-contained: the training
+        samples are not needed for the prediction. Models learned on precomputed kernels can not be saved.
+        Input:
+            filename: the name of the file
+        Output: None
+        '''
+        if (self.X is None) and (self.approx is None):
+            raise ValueError('The model has no support vectors (precomputed kernel or untrained model) and can not be saved')
+        Beta,Beta_shapes = pack_arrays(self.Beta)
+        a,a_shapes = pack_arrays(self.a)
+        w,w_shapes = pack_arrays(self.w)
+        km,km_shapes = pack_arrays(self.km)
+        E,E_shapes = pack_arrays(self.E)
+        extra = {}
+        if self.approx is not None:
+            extra['M'],extra['M_shapes'] = pack_arrays(self.M)
+        if self.X is not None: # The norms of the support vectors are saved, so they are not read at the loading
+            extra['X'],extra['idx'] = self.X,self.idx
+            extra['mu'],extra['z2'] = self.norms if self.norms is not None else sq_norms(self.X)
+        sp.savez(filename,model=self.model,kernel=self.kernel,sig=self.sig,dc=self.dc,threshold=self.threshold,
+                 approx=str(self.approx),m=self.m,sampling=self.sampling,
+                 b=self.b,ib=self.ib,prop=sp.asarray(self.prop),ni=sp.asarray(self.ni),di=sp.asarray(self.di),ri=sp.asarray(self.ri),
+                 s=sp.asarray(self.s),cst=sp.asarray(self.cst),Beta=Beta,Beta_shapes=Beta_shapes,a=a,a_shapes=a_shapes,
+                 w=w,w_shapes=w_shapes,km=km,km_shapes=km_shapes,E=E,E_shapes=E_shapes,trace=sp.asarray(self.trace),**extra)
+
+    def load(self,filename,mmap_mode=None):
+        '''
+        The function loads a model saved with the function save
+        Input:
+            filename: the name of the file
+            mmap_mode: if given, the arrays of the model are memory-mapped from the file (see load_npz)
+        Output: None - The model is included in the object
+        '''
+        data = load_npz(filename,mmap_mode=mmap_mode)
+        self.model=str(data['model'])
+        self.kernel=str(data['kernel'])
+        self.sig=float(data['sig'])
+        self.dc=int(data['dc'])
+        self.threshold=float(data['threshold'])
+        self.b=float(data['b'])
+        self.ib=float(data['ib'])
+        self.prop=data['prop'].tolist()
+        self.ni=data['ni'].tolist()
+        self.di=data['di'].tolist()
+        self.ri=data['ri'].tolist()
+        self.s=data['s'].tolist()
+        self.cst=data['cst'].tolist()
+        self.X,self.idx,self.norms=None,None,None
+        if 'X' in data: # No support vectors with the random features
+            self.X=data['X']
+            self.norms=(data['mu'],data['z2']) if 'z2' in data else sq_norms(self.X) # Files saved without the norms
+            self.idx=data['idx']
+        self.Beta=unpack_arrays(data['Beta'],data['Beta_shapes'])
+        self.a=unpack_arrays(data['a'],data['a_shapes'])
+        self.w=unpack_arrays(data['w'],data['w_shapes'])
+        self.km=unpack_arrays(data['km'],data['km_shapes'])
+        self.E,self.trace=[],[]
+        if 'E' in data: # Needed to update the model
+            self.E=unpack_arrays(data['E'],data['E_shapes'])
+            self.trace=data['trace'].tolist()
+        self.approx=None
+        self.M=[]
+        if 'approx' in data: # Models saved before the approximation modes are exact
+            self.approx=None if str(data['approx']) == 'None' else str(data['approx'])
+            self.m=int(data['m'])
+            self.sampling=str(data['sampling'])
+        if self.approx is not None:
+            self.M=unpack_arrays(data['M'],data['M_shapes'])
+        self.t=[]
+        self.precomputed=None
     
-    def cross_validation(self,x,y,v=5,sig_r=2.0**sp.arange(-8,0),threshold_r=sp.linspace(0.85,0.9999,10),dc_r=sp.arange(5,50)):
+    def cross_validation(self,x,y,v=5,sig_r=2.0**sp.arange(-8,0),threshold_r=sp.linspace(0.85,0.9999,10),dc_r=sp.arange(5,50),n_jobs=1,search='grid'):
         '''
-        To be done and can be changed by using pre-computed kernels
+        The function selects the kernel parameter and the threshold (or dc) by v-fold cross-validation
+        Input:
+            x,y: the sample matrix and the label
+            v: the number of folds
+            sig_r: the values of the kernel parameter
+            threshold_r,dc_r: the values of the threshold or of dc, depending on the model
+            n_jobs: the number of processes used to run the folds and the values of sig in parallel, -1 for all the cpus
+            search: 'grid' (all the values of the parameters on all the folds) or 'halving' (successive halving over the
+                    values of sig, then refinement of sig, see search_halving)
+        Output:
+            sig: the selected kernel parameter
+            threshold or dc: the selected model parameter
+            err: the classification error for each value of sig and of the model parameter
+            trace: the evaluations of the 'halving' search
         '''
-        # Get parameters
-        n=x.shape[0]
-        ns = sig_r.size
-        nt = threshold_r.size
-        nd = dc_r.size
-        if self.model == 'M0' or self.model=='M2' or self.model =='M5':
-            err = sp.zeros((ns,nt))
-        else:
-            err = sp.zeros((ns,nd))
-            
+        tic = profiling.start()
         # Initialization of the indices for the cross validation
         cv = CV()           
         cv.split_data_class(y,v=v)
+        template = PGPDA(model=self.model,kernel=self.kernel,solver=self.solver,approx=self.approx,m=self.m,sampling=self.sampling)
         
         # Start the cross-validation
         if self.model == 'M0' or self.model=='M2' or self.model =='M5':
-            for i in range(ns):
-                for k in range(v):
-                    # Precompute the E and Beta
-                    E_,Beta_=pre_compute_E_Beta(x[cv.it[k],:],y[cv.it[k]],sig_r[i])
-                    # test several threshold
-                    for j in range(nt):
-                        model_temp = PGPDA(model=self.model,kernel=self.kernel)
-                        model_temp.train(x[cv.it[k],:],y[cv.it[k]],sig=sig_r[i],threshold=threshold_r[j],fast=1,E_=E_,Beta_=Beta_)
-                        yp = model_temp.predict(x[cv.iT[k],:],x[cv.it[k],:],y[cv.it[k]])
-                        yp.shape = y[cv.iT[k]].shape                        
-                        t = sp.where(yp!=y[cv.iT[k]])[0]
-                        err[i,j]+= float(t.size)/yp.size
-                        del model_temp
-            err/=v
-            t = sp.where(err==err.min())
-            self.sig = sig_r[t[0][0]]
-            self.threshold = threshold_r[t[1][0]]
-            return sig_r[t[0][0]],threshold_r[t[1][0]],err
-                        
+            param,param_r = 'threshold',threshold_r
+        else:
+            param,param_r = 'dc',dc_r
+        if search == 'halving':
+            sig,p,err,trace = search_halving(template,x,y,cv,sig_r,param,param_r,n_jobs=n_jobs)
         else:
-            for i in range(ns):
-                for k in range(v):
-                    # Precompute the E and Beta
-                    E_,Beta_=pre_compute_E_Beta(x[cv.it[k],:],y[cv.it[k]],sig_r[i])
-                    # test several threshold
-                    for j in range(nd):
-                        model_temp = PGPDA(model=self.model,kernel=self.kernel)
-                        model_temp.train(x[cv.it[k],:],y[cv.it[k]],sig=sig_r[i],dc=dc_r[j],fast=1,E_=E_,Beta_=Beta_)
-                        yp = model_temp.predict(x[cv.iT[k],:],x[cv.it[k],:],y[cv.it[k]])
-                        yp.shape = y[cv.iT[k]].shape
-                        t = sp.where(yp!=y[cv.iT[k]])[0]
-                        err[i,j]+= float(t.size)/yp.size
-                        del model_temp
-            err/=v
+            err = run_cross_validation(template,x,y,cv,sig_r,param,param_r,n_jobs=n_jobs)
             t = sp.where(err==err.min())
-            self.sig = sig_r[t[0][0]]
-            self.dc = dc_r[t[1][0]]
-            return sig_r[t[0][0]],dc_r[t[1][0]],err
+            sig,p = sig_r[t[0][0]],param_r[t[1][0]]
+        self.sig = sig
+        if param == 'threshold':
+            self.threshold = p
+        else:
+            self.dc = p
+        profiling.stop(self.__class__.__name__+'.cross_validation',tic)
+
+        if search == 'halving':
+            return sig,p,err,trace
+        else:
+            return sig,p,err
 
 class NPGPDA: # Parcimonious Gaussian Process Discriminant Analysis with class specific noise
-    def __init__(self,model='NM0',kernel='RBF',sig=None,dc=None,threshold=None):
+    def __init__(self,model='NM0',kernel='RBF',sig=None,dc=None,threshold=None,solver='full',approx=None,m=100,sampling='uniform'):
         self.model=model
         self.kernel=kernel
+        self.solver=solver
+        self.approx=approx
+        self.m=m
+        self.sampling=sampling
         self.sig=sig
         self.dc=dc
         self.threshold=threshold
-        self.A=[]
+        self.w=[]
+        self.cst=[]
         self.Beta=[]
         self.b = []
         self.ib = []
         self.a = []
+        self.E = []
+        self.trace = []
         self.prop = []
         self.ni= []
         self.di = []
         self.ri = []
+        self.km = []
+        self.s = []
+        self.X = None
+        self.norms = None
+        self.idx = None
+        self.t = []
+        self.M = []
         self.precomputed = None
 
-    def train(self,x,y,sig=None,dc=None,threshold=None,fast=None,E_=None,Beta_=None):
+    def train(self,x,y,sig=None,dc=None,threshold=None,fast=None,E_=None,Beta_=None,S_=None,n_jobs=1,parallel='thread'):
         '''
         The function trains the pgpda model using the training samples
         Inputs:
@@ -502,10 +1645,19 @@ class NPGPDA: # Parcimonious Gaussian Process Discriminant Analysis with class s
         dc: the number of dimension of the singanl subspace
         threshold: the value of the cummulative variance that should be reached
         fast = option used to perform a fast CV: only the parameter dc/threshold is learn
+        E_,Beta_,S_: the pre computed eigenvalues, eigenvectors and centering statistics (fast option)
+        n_jobs: the number of classes processed in parallel, -1 for all the cpus
+        parallel: 'thread' or 'process', see map_classes
+        The eigen solver is given by self.solver, see eig_kernel
+        With self.approx='nystrom', the kernel of each class is approximated from self.m landmarks selected with
+        self.sampling (see select_landmarks), and the model is learned in the feature space of the landmarks.
+        With self.approx='rff' (RBF kernel), the model is learned in the space of self.m random Fourier features shared
+        by all the classes (see rff_map): the prediction cost does not depend on the number of training samples.
         
         Outputs:
         None - The model is included/updated in the object
         '''
+        tic = profiling.start()
 
         # Initialization
         n = y.shape[0]
@@ -532,73 +1684,135 @@ class NPGPDA: # Parcimonious Gaussian Process Discriminant Analysis with class s
         if (list_model_dc.find(self.model) > -1): 
             for i in range(C):
                 ni = sp.size(sp.where(y==(i+1))[0])
+                if self.approx is not None:
+                    ni = min(ni,self.m)
                 if self.dc >= ni-1:
                     self.dc=ni-2
 
         # Estimate the parameters of each class
+        # Eigen decomposition of the kernel of each class, the classes are processed in parallel if n_jobs > 1
+        if fast is None:
+            if list_model_dc.find(self.model) == -1:
+                d,thrs = None,self.threshold
+            else:
+                d,thrs = self.dc,None
+            if self.approx == 'nystrom':
+                if self.precomputed is not None:
+                    raise ValueError('The Nystrom approximation can not be used with a precomputed kernel')
+                units = ((x[sp.where(y==(i+1))[0],:],self.kernel,self.sig,self.m,self.sampling,i,self.solver,d,thrs) for i in range(C))
+                res = map_classes(class_eigen_nystrom,units,n_jobs=n_jobs,parallel=parallel)
+            elif self.approx == 'rff':
+                if (self.precomputed is not None) or (self.kernel != 'RBF'):
+                    raise ValueError('The random Fourier features need the samples and the RBF kernel')
+                W,phase = rff_map(x.shape[1],self.m,self.sig)
+                self.M = [W,phase]
+                units = ((x[sp.where(y==(i+1))[0],:],W,phase,self.solver,d,thrs) for i in range(C))
+                res = map_classes(class_eigen_rff,units,n_jobs=n_jobs,parallel=parallel)
+            elif self.approx is not None:
+                raise ValueError('Unknown approximation '+str(self.approx)+', available approximations: nystrom, rff')
+            else:
+                if self.precomputed is None:
+                    units = ((x[sp.where(y==(i+1))[0],:],None,None,self.kernel,self.sig,self.solver,d,thrs) for i in range(C))
+                else:
+                    units = ((None,x.K[sp.ix_(sp.where(y==(i+1))[0],sp.where(y==(i+1))[0])],None,self.kernel,self.sig,self.solver,d,thrs) for i in range(C))
+                res = map_classes(class_eigen,units,n_jobs=n_jobs,parallel=parallel)
+            landmarks = []
+
         for i in range(C):
             t = sp.where(y==(i+1))[0]
             self.ni.append(sp.size(t))
             self.prop.append(float(self.ni[i])/n)
 
+            if self.precomputed is not None:
+                self.t.append(t)
+
             if fast is None:
-                # Compute Mi
-                Ki= KERNEL()
-                if self.precomputed is None:
-                    Ki.compute_kernel(x[t,:],kernel=self.kernel,sig=self.sig)                
-                else:
-                    Ki.K = x.K[t,:][:,t].copy()
-                    Ki.rank = Ki.K.shape[0]
-                    
-                self.ri.append(Ki.rank-1)
-                Ki.center_kernel()
-                Ki.scale_kernel(self.ni[i])
-                TraceKi = sp.trace(Ki.K)
-            
-                # Eigenvalue decomposition  
-                E,Beta = linalg.eigh(Ki.K)
-                idx = E.argsort()[::-1]
-                E = E[idx]
-                E[E<eps]=eps
-                Beta = Beta[:,idx]
+                E,Beta,S,rank = next(res)
+                self.ri.append(rank-1)
+                self.km.append(S[0])
+                self.s.append(S[1])
+                TraceKi = S[2]
+                if self.approx == 'nystrom':
+                    landmarks.append(S[3])
+                    self.M.append(S[4])
             else:
                 E=E_[i]
                 Beta=Beta_[i]
-                self.ri.append(E.size-1)
-                TraceKi = sp.sum(E)
+                self.ri.append(Beta.shape[0]-1)
+                self.km.append(S_[i][0])
+                self.s.append(S_[i][1])
+                TraceKi = S_[i][2]
             
             # Parameter estimation
-            if list_model_dc.find(self.model) == -1:
-                di = estim_d(E[0:self.ri[i]-1],self.threshold)
-            else:
-                di = self.dc
+            di = self.estimate_dimension(E,Beta,TraceKi,self.ri[i])
             self.di.append(di)
-            self.a.append(E[0:di])
-            self.b.append((TraceKi-sp.sum(self.a[i]))/(self.ri[i]-di))
+            self.E.append(E[0:di].copy())
+            self.trace.append(TraceKi)
+            if fast is None:
+                self.Beta.append(Beta[:,0:di].copy()) # Copy to release the full eigenvector matrix
+            else:
+                self.Beta.append(Beta[:,0:di]) # View on the shared pre computed eigenvectors
+            del Beta,E
+        if fast is None:
+            res.close() # Release the workers
 
+        # Store the support vectors (the landmarks with the Nystrom approximation, none with the random features), ordered by class
+        if self.approx is None:
+            self.idx = sp.concatenate(([0],sp.cumsum(self.ni)))
+            if self.precomputed is None:
+                self.X = sp.empty((n,x.shape[1]))
+                for i in range(C):
+                    self.X[self.idx[i]:self.idx[i+1],:] = x[sp.where(y==(i+1))[0],:]
+        elif self.approx == 'nystrom':
+            self.idx = sp.concatenate(([0],sp.cumsum([l.shape[0] for l in landmarks])))
+            self.X = sp.concatenate(landmarks)
+            del landmarks
+        if self.X is not None:
+            self.norms = sq_norms(self.X)
+        self.estimate_parameters()
+        profiling.stop(self.__class__.__name__+'.train',tic,samples=n)
+
+    def estimate_dimension(self,E,Beta,trace,ri):
+        '''
+        The function estimates the dimension of the signal subspace of a class
+        Input:
+            E,Beta: the eigenvalues and eigenvectors of the centered scaled kernel of the class
+            trace: the trace of the centered scaled kernel
+            ri: the rank of the class
+        Output:
+            di: the dimension
+        '''
+        if self.model in MODELS_DC:
+            return self.dc
+        elif E.size == Beta.shape[0]: # The full spectrum is available
+            return estim_d(E[0:ri-1],self.threshold)
+        else: # Only the leading eigenvalues are available
+            return estim_d(E,self.threshold,trace=trace)
+
+    def estimate_parameters(self):
+        '''
+        The function derives the parameters of the model from the leading eigenvalues, the trace and the dimension of the
+        signal subspace of each class: the noise b of each class, the eigenvalues a of the model and the decision
+        function. It is the last step of train and update.
+        '''
+        tic = profiling.start()
+        C = len(self.ni)
+        eps = sp.finfo(sp.float64).eps
+        self.a = [E.copy() for E in self.E]
+        self.b,self.ib = [],[]
+        for i in range(C):
+            self.b.append((self.trace[i]-sp.sum(self.a[i]))/(self.ri[i]-self.di[i]))
             if self.b[i] < eps:# Sanity check for numerical precision
                 self.b[i] = eps
                 self.ib.append(1.0/eps)
             else:
-                self.ib.append(1/self.b[i])                
-            self.Beta.append(Beta[:,0:di])
-            del Beta,E
+                self.ib.append(1/self.b[i])
 
-            
         # Finish the estimation for the different models
-        if self.model == 'NM0' or self.model == 'NM1':
-            for i in range(C):
-                # Compute the value of matrix A
-                temp =self.Beta[i]*((1/self.a[i]-self.ib[i])/self.a[i]).reshape(self.di[i])
-                self.A.append(sp.dot(temp,self.Beta[i].T)/self.ni[i])
-
-        elif self.model == 'NM2' or self.model == 'NM3':
+        if self.model == 'NM2' or self.model == 'NM3':
             for i in range(C):
                 # Update the value of a
                 self.a[i][:]=sp.mean(self.a[i])
-                # Compute the value of matrix A
-                temp =self.Beta[i]*((1/self.a[i]-self.ib[i])/self.a[i]).reshape(self.di[i])
-                self.A.append(sp.dot(temp,self.Beta[i].T)/self.ni[i])
 
         elif self.model == 'NM4': 
             # Compute the value of a
@@ -608,24 +1822,100 @@ class NPGPDA: # Parcimonious Gaussian Process Discriminant Analysis with class s
                     al[i] += self.prop[j]*self.a[j][i]
             for i in range(C):
                 self.a[i]=al.copy()
-                temp =self.Beta[i]*((1/self.a[i]-self.ib[i])/self.a[i]).reshape(self.di[i])
-                self.A.append(sp.dot(temp,self.Beta[i].T)/self.ni[i])
 
-        self.A = sp.asarray(self.A)
+        # Compute the weights of the low rank decision function: A = Beta diag(w) Beta^T is never formed
+        self.w,self.cst = [],[]
+        for i in range(C):
+            self.w.append((1/self.a[i]-self.ib[i])/self.a[i]/self.ni[i])
+            self.cst.append(sp.sum(sp.log(self.a[i])) + (self.ri[i]-self.di[i])*sp.log(self.b[i]) -2*sp.log(self.prop[i]))
+        profiling.stop('estimate',tic)
+
+    def update(self,x_new,y_new,n_jobs=1,parallel='thread'):
+        '''
+        The function updates the learned model with new samples, of the learned classes or of new classes (labeled C+1,
+        C+2, ...). Only the classes with new samples are learned again, from their support vectors and their new samples.
+        With the 'lobpcg' solver, their eigen decomposition is started from the current eigenvectors. The parameters
+        shared by the classes are then derived again, see estimate_parameters.
+        Input:
+            x_new,y_new: the new samples and their label
+            n_jobs,parallel: the number of classes processed in parallel and the kind of workers, see map_classes
+        Output:
+            None - The model is updated in the object
+        '''
+        tic = profiling.start()
+        if (self.approx is not None) or (self.X is None):
+            raise ValueError('Only the exact models learned on the samples can be updated')
+        y_new = sp.asarray(y_new).ravel()
+        C = len(self.ni)
+        classes = sp.unique(y_new).astype(int)
+        if (classes.min() < 1) or (set(range(C+1,classes.max()+1))-set(classes)):
+            raise ValueError('The labels of the new classes must follow the labels of the learned classes')
+        if self.model in MODELS_DC:
+            d,thrs = self.dc,None
+        else:
+            d,thrs = None,self.threshold
+
+        # Samples of the classes to learn again, started from the current eigenvectors with the 'lobpcg' solver
+        xs = [self.X[self.idx[i]:self.idx[i+1],:] for i in range(C)]
+        units = []
+        for c in classes:
+            t = sp.where(y_new==c)[0]
+            X0 = None
+            if c <= C:
+                xs[c-1] = sp.concatenate((xs[c-1],x_new[t,:]))
+                if self.solver == 'lobpcg':
+                    X0 = sp.concatenate((self.Beta[c-1],sp.zeros((t.size,self.di[c-1]))))
+            else:
+                xs.append(x_new[t,:])
+            # Check of consistent dimension
+            if (self.model in MODELS_DC) and (self.dc >= xs[c-1].shape[0]-1):
+                self.dc = xs[c-1].shape[0]-2
+            units.append((xs[c-1],None,None,self.kernel,self.sig,self.solver,d,thrs,X0))
+
+        for c,(E,Beta,S,rank) in zip(classes,map_classes(class_eigen,units,n_jobs=n_jobs,parallel=parallel)):
+            i = c-1
+            if i == len(self.ni): # New class
+                for l in (self.ni,self.ri,self.km,self.s,self.trace,self.di,self.E,self.Beta):
+                    l.append(None)
+            self.ni[i] = Beta.shape[0]
+            self.ri[i] = rank-1
+            self.km[i],self.s[i],self.trace[i] = S
+            self.di[i] = self.estimate_dimension(E,Beta,S[2],self.ri[i])
+            self.E[i] = E[0:self.di[i]].copy()
+            self.Beta[i] = Beta[:,0:self.di[i]].copy()
+            del E,Beta
+
+        # The dimension of the models with a common dc can only decrease
+        if self.model in MODELS_DC:
+            for i in range(len(self.ni)):
+                self.di[i] = self.dc
+                self.E[i] = self.E[i][0:self.dc]
+                self.Beta[i] = self.Beta[i][:,0:self.dc]
 
+        # Support vectors and proportions
+        n = sum(self.ni)
+        self.prop = [float(ni)/n for ni in self.ni]
+        self.idx = sp.concatenate(([0],sp.cumsum(self.ni)))
+        self.X = sp.concatenate(xs)
+        self.norms = sq_norms(self.X)
+        del xs,units
+        self.estimate_parameters()
+        profiling.stop(self.__class__.__name__+'.update',tic,samples=n)
 
-    def predict(self,xt,x,y,out_decision=None,out_proba=None):
+    def predict(self,xt,x=None,y=None,out_decision=None,out_proba=None,shift=True):
         '''
         The function predicts the label for each sample with the learned model
         Input:
-            xt: the test samples
-            x: the samples matrix of size n x d
-            y: the vector with label of size n
+            xt: the test samples, for the precomputed case, xt is a KERNEL object
+            x,y: not used, kept for compatibility. The model stores its own support vectors (or landmarks).
+            shift: if True, the decision functions are shifted such as their minimum over the test samples is zero
+                   (if negative). The labels and the posterior probabilities do not depend on it.
         Output
             yp: the label
             D: the discriminant function
             P: the posterior probabilities
         '''
+        tic = profiling.start()
          
         # Initialization
         if isinstance(xt,sp.ndarray):
@@ -633,37 +1923,50 @@ class NPGPDA: # Parcimonious Gaussian Process Discriminant Analysis with class s
         else:
             nt = xt.K.shape[0]
             
-        C = int(y.max())
+        C = len(self.ni)
         eps = sp.finfo(sp.float64).eps
-        dm = max(self.di)
 
         D = sp.empty((nt,C))
-        Ki = KERNEL()
         Kt = KERNEL()
         kd = KERNEL()
+
+        # Kernel between the test samples and all the support vectors (ordered by class), or random features, computed once
+        if self.precomputed is None:
+            K = KERNEL()
+            if self.approx == 'rff':
+                K.compute_rff(xt,self.M[0],self.M[1])
+            else:
+                K.compute_kernel(xt,z=self.X,kernel=self.kernel,sig=self.sig,norms=self.norms)
         
         for i in range(C):
-            t = sp.where(y==(i+1))[0]
-            cst = sp.sum(sp.log(self.a[i])) + (self.ri[i]-self.di[i])*sp.log(self.b[i]) -2*sp.log(self.prop[i]) 
             if self.precomputed is None:
-                Ki.compute_kernel(x[t,:],kernel=self.kernel,sig=self.sig)
-                Kt.compute_kernel(xt,z=x[t,:],kernel=self.kernel,sig=self.sig)
+                if self.approx == 'rff':
+                    Kt.K = K.K.copy()
+                else:
+                    Kt.K = K.K[:,self.idx[i]:self.idx[i+1]]
                 kd.compute_diag_kernel(xt,kernel=self.kernel,sig=self.sig)
             else:
-                Ki.K= x.K[t,:][:,t].copy()
-                Kt.K= xt.K[:,t].copy()
+                Kt.K= xt.K[:,self.t[i]].copy()
                 kd.K= xt.kd.copy()
-            Kt.center_kernel(Ko=Ki, kd=kd)
-            Ki.K=None
+            if self.approx is None:
+                Kt.center_kernel(kd=kd,km=self.km[i],s=self.s[i])
+            else: # Features of the testing samples, the decision rule is unchanged
+                if self.approx == 'nystrom':
+                    Kt.K = sp.dot(Kt.K,sp.asarray(self.M[i],dtype=Kt.K.dtype))
+                Kt.center_features(kd=kd,mu=self.km[i])
 
-            #Compute the decision rule
-            temp = sp.dot(Kt.K,self.A[i])
-            D[:,i] = sp.sum(Kt.K*temp,axis=1)
-            D[:,i] += kd.K*self.ib[i]+cst           
+            #Compute the decision rule: sum_j w_j*(Kt*beta_j)^2, in O(nt*ni*di), in the type of the kernel
+            temp = sp.dot(Kt.K,sp.asarray(self.Beta[i],dtype=Kt.K.dtype))
+            temp **= 2
+            D[:,i] = sp.dot(temp,self.w[i])
+            D[:,i] += kd.K*self.ib[i]+self.cst[i]           
+        profiling.stop(self.__class__.__name__+'.predict',tic,samples=nt)
             
         # Check if negative value
-        if D.min() <0:
-            D-=D.min()
+        Dmin = min(D.min(),0)
+        if shift:
+            D-=Dmin
+            Dmin = 0
         
         yp = D.argmin(1)+1
         yp.shape=(nt,1)
@@ -676,88 +1979,163 @@ class NPGPDA: # Parcimonious Gaussian Process Discriminant Analysis with class s
                 return yp,D
         else:        
             # Compute posterior !! Should be changed to a safe version
-            P = sp.exp(-0.5*D)
+            P = sp.exp(-0.5*(D-Dmin))
             P /= sp.sum(P,axis=1).reshape(nt,1)
             P[P<eps]=0                    
         return yp,D,P
 
-    def cross_validation(self,x,y,v=5,sig_r=2.0**sp.arange(-8,0),threshold_r=sp.linspace(0.85,0.9999,10),dc_r=sp.arange(5,50)):
+    def save(self,filename):
         '''
-        To be done and can be changed by using pre-computed kernels
+        The function saves the learned model in an uncompressed npz file. The saved model is self-contained: the training
+        samples are not needed for the prediction. Models learned on precomputed kernels can not be saved.
+        Input:
+            filename: the name of the file
+        Output: None
         '''
-        # Get parameters
-        n=x.shape[0]
-        ns = sig_r.size
-        nt = threshold_r.size
-        nd = dc_r.size
-        if self.model == 'NM0' or self.model=='NM2' or self.model =='NM5':
-            err = sp.zeros((ns,nt))
-        else:
-            err = sp.zeros((ns,nd))
-            
+        if (self.X is None) and (self.approx is None):
+            raise ValueError('The model has no support vectors (precomputed kernel or untrained model) and can not be saved')
+        Beta,Beta_shapes = pack_arrays(self.Beta)
+        a,a_shapes = pack_arrays(self.a)
+        w,w_shapes = pack_arrays(self.w)
+        km,km_shapes = pack_arrays(self.km)
+        E,E_shapes = pack_arrays(self.E)
+        extra = {}
+        if self.approx is not None:
+            extra['M'],extra['M_shapes'] = pack_arrays(self.M)
+        if self.X is not None: # The norms of the support vectors are saved, so they are not read at the loading
+            extra['X'],extra['idx'] = self.X,self.idx
+            extra['mu'],extra['z2'] = self.norms if self.norms is not None else sq_norms(self.X)
+        sp.savez(filename,model=self.model,kernel=self.kernel,sig=self.sig,dc=self.dc,threshold=self.threshold,
+                 approx=str(self.approx),m=self.m,sampling=self.sampling,
+                 b=sp.asarray(self.b),ib=sp.asarray(self.ib),prop=sp.asarray(self.prop),ni=sp.asarray(self.ni),di=sp.asarray(self.di),ri=sp.asarray(self.ri),
+                 s=sp.asarray(self.s),cst=sp.asarray(self.cst),Beta=Beta,Beta_shapes=Beta_shapes,a=a,a_shapes=a_shapes,
+                 w=w,w_shapes=w_shapes,km=km,km_shapes=km_shapes,E=E,E_shapes=E_shapes,trace=sp.asarray(self.trace),**extra)
+
+    def load(self,filename,mmap_mode=None):
+        '''
+        The function loads a model saved with the function save
+        Input:
+            filename: the name of the file
+            mmap_mode: if given, the arrays of the model are memory-mapped from the file (see load_npz)
+        Output: None - The model is included in the object
+        '''
+        data = load_npz(filename,mmap_mode=mmap_mode)
+        self.model=str(data['model'])
+        self.kernel=str(data['kernel'])
+        self.sig=float(data['sig'])
+        self.dc=int(data['dc'])
+        self.threshold=float(data['threshold'])
+        self.b=data['b'].tolist()
+        self.ib=data['ib'].tolist()
+        self.prop=data['prop'].tolist()
+        self.ni=data['ni'].tolist()
+        self.di=data['di'].tolist()
+        self.ri=data['ri'].tolist()
+        self.s=data['s'].tolist()
+        self.cst=data['cst'].tolist()
+        self.X,self.idx,self.norms=None,None,None
+        if 'X' in data: # No support vectors with the random features
+            self.X=data['X']
+            self.norms=(data['mu'],data['z2']) if 'z2' in data else sq_norms(self.X) # Files saved without the norms
+            self.idx=data['idx']
+        self.Beta=unpack_arrays(data['Beta'],data['Beta_shapes'])
+        self.a=unpack_arrays(data['a'],data['a_shapes'])
+        self.w=unpack_arrays(data['w'],data['w_shapes'])
+        self.km=unpack_arrays(data['km'],data['km_shapes'])
+        self.E,self.trace=[],[]
+        if 'E' in data: # Needed to update the model
+            self.E=unpack_arrays(data['E'],data['E_shapes'])
+            self.trace=data['trace'].tolist()
+        self.approx=None
+        self.M=[]
+        if 'approx' in data: # Models saved before the approximation modes are exact
+            self.approx=None if str(data['approx']) == 'None' else str(data['approx'])
+            self.m=int(data['m'])
+            self.sampling=str(data['sampling'])
+        if self.approx is not None:
+            self.M=unpack_arrays(data['M'],data['M_shapes'])
+        self.t=[]
+        self.precomputed=None
+    
+    def cross_validation(self,x,y,v=5,sig_r=2.0**sp.arange(-8,0),threshold_r=sp.linspace(0.85,0.9999,10),dc_r=sp.arange(5,50),n_jobs=1,search='grid'):
+        '''
+        The function selects the kernel parameter and the threshold (or dc) by v-fold cross-validation
+        Input:
+            x,y: the sample matrix and the label
+            v: the number of folds
+            sig_r: the values of the kernel parameter
+            threshold_r,dc_r: the values of the threshold or of dc, depending on the model
+            n_jobs: the number of processes used to run the folds and the values of sig in parallel, -1 for all the cpus
+            search: 'grid' (all the values of the parameters on all the folds) or 'halving' (successive halving over the
+                    values of sig, then refinement of sig, see search_halving)
+        Output:
+            sig: the selected kernel parameter
+            threshold or dc: the selected model parameter
+            err: the classification error for each value of sig and of the model parameter
+            trace: the evaluations of the 'halving' search
+        '''
+        tic = profiling.start()
         # Initialization of the indices for the cross validation
         cv = CV()           
         cv.split_data_class(y,v=v)
+        template = NPGPDA(model=self.model,kernel=self.kernel,solver=self.solver,approx=self.approx,m=self.m,sampling=self.sampling)
         
         # Start the cross-validation
         if self.model == 'NM0' or self.model=='NM2' or self.model =='NM5':
-            for i in range(ns):
-                for k in range(v):
-                    # Precompute the E and Beta
-                    E_,Beta_=pre_compute_E_Beta(x[cv.it[k],:],y[cv.it[k]],sig_r[i])
-                    # test several threshold
-                    for j in range(nt):
-                        model_temp = NPGPDA(model=self.model,kernel=self.kernel)
-                        model_temp.train(x[cv.it[k],:],y[cv.it[k]],sig=sig_r[i],threshold=threshold_r[j],fast=1,E_=E_,Beta_=Beta_)
-                        yp = model_temp.predict(x[cv.iT[k],:],x[cv.it[k],:],y[cv.it[k]])
-                        yp.shape = y[cv.iT[k]].shape                        
-                        t = sp.where(yp!=y[cv.iT[k]])[0]
-                        err[i,j]+= float(t.size)/yp.size
-                        del model_temp
-            err/=v
-            t = sp.where(err==err.min())
-            self.sig = sig_r[t[0][0]]
-            self.threshold = threshold_r[t[1][0]]
-            return sig_r[t[0][0]],threshold_r[t[1][0]],err
-                        
+            param,param_r = 'threshold',threshold_r
         else:
-            for i in range(ns):
-                for k in range(v):
-                    # Precompute the E and Beta
-                    E_,Beta_=pre_compute_E_Beta(x[cv.it[k],:],y[cv.it[k]],sig_r[i])
-                    # test several threshold
-                    for j in range(nd):
-                        model_temp = NPGPDA(model=self.model,kernel=self.kernel)
-                        model_temp.train(x[cv.it[k],:],y[cv.it[k]],sig=sig_r[i],dc=dc_r[j],fast=1,E_=E_,Beta_=Beta_)
-                        yp = model_temp.predict(x[cv.iT[k],:],x[cv.it[k],:],y[cv.it[k]])
-                        yp.shape = y[cv.iT[k]].shape
-                        t = sp.where(yp!=y[cv.iT[k]])[0]
-                        err[i,j]+= float(t.size)/yp.size
-                        del model_temp
-            err/=v
+            param,param_r = 'dc',dc_r
+        if search == 'halving':
+            sig,p,err,trace = search_halving(template,x,y,cv,sig_r,param,param_r,n_jobs=n_jobs)
+        else:
+            err = run_cross_validation(template,x,y,cv,sig_r,param,param_r,n_jobs=n_jobs)
             t = sp.where(err==err.min())
-            self.sig = sig_r[t[0][0]]
-            self.dc = dc_r[t[1][0]]
-            return sig_r[t[0][0]],dc_r[t[1][0]],err
+            sig,p = sig_r[t[0][0]],param_r[t[1][0]]
+        self.sig = sig
+        if param == 'threshold':
+            self.threshold = p
+        else:
+            self.dc = p
+        profiling.stop(self.__class__.__name__+'.cross_validation',tic)
+
+        if search == 'halving':
+            return sig,p,err,trace
+        else:
+            return sig,p,err
 
 class KDA: # Kernel QDA from "Toward an Optimal Supervised Classifier for the Analysis of Hyperspectral Data"
-    def __init__(self,mu=None,sig=None):
+    def __init__(self,mu=None,sig=None,rank=None):
         self.a = []
-        self.A = []
-        self.S = []
+        self.F = None
+        self.q = []
+        self.X = None
+        self.norms = None
         self.ni = []
         self.prop=[]
         self.sig=sig
         self.mu=mu
+        self.rank=rank
+        self.precomputed = None
     
     def train(self,x,y,mu=None,sig=None):
+        '''
+        The function trains the KDA model using the training samples
+        Inputs:
+        x: the samples matrix of size n x d, for the precomputed case (self.precomputed==1), x is a KERNEL object.
+        y: the vector with label of size n
+        mu: the regularization parameter
+        sig: the parameter of the kernel function
+        With self.rank=r, the kernel is approximated with a pivoted Cholesky factor of rank at most r (K ~ LL'), and the
+        generalized eigenvalue problem is reduced to a r x r eigenvalue problem: the n x n kernel is never formed.
+        '''
+        tic = profiling.start()
         # Initialization
         n = y.shape[0]
         C = int(y.max())
         eps = sp.finfo(sp.float64).eps 
         
         if (mu is None) and (self.mu is None):
-            mu=10**(-7)
+            self.mu=10**(-7)
         elif self.mu is None:
             self.mu =mu
             
@@ -766,28 +2144,65 @@ class KDA: # Kernel QDA from "Toward an Optimal Supervised Classifier for the An
         elif self.sig is None:
             self.sig=sig
         
-        # Compute K and 
-        K = KERNEL()
-        K.compute_kernel(x,sig=self.sig)
-        G = KERNEL()
-        G.K = self.mu*sp.eye(n)
-                    
+        # Class indicators: the centering of each class (multiplication by T = I - 11') is a rank one correction
+        Y = sp.zeros((n,C))
         for i in range(C):
             t = sp.where(y==(i+1))[0]
             self.ni.append(sp.size(t))
             self.prop.append(float(self.ni[i])/n)
+            Y[t,i] = 1
+        ni = sp.asarray(self.ni,dtype=sp.float64)
+        w = 1/ni[sp.asarray(y).ravel().astype(int)-1] # 1/ni of the class of each sample
         
-            # Compute K_k
-            Ki = KERNEL()
-            Ki.compute_kernel(x, z=x[t,:],sig=self.sig)
-            T = (sp.eye(self.ni[i])-sp.ones((self.ni[i],self.ni[i])))
-            Ki.K = sp.dot(Ki.K,T)
-            del T
-            G.K += sp.dot(Ki.K,Ki.K.T)/self.ni[i]
-        G.scale_kernel(C)
-        
-        # Solve the generalized eigenvalue problem
-        a,A = linalg.eigh(G.K,b=K.K)
+        if self.rank is None:
+            # Compute K, in double precision for the generalized eigenvalue problem
+            K = KERNEL()
+            if self.precomputed is None:
+                K.compute_kernel(x,sig=self.sig,dtype=sp.float64)
+            else:
+                K.K = sp.asarray(x.K,dtype=sp.float64)
+            
+            # G = (mu I + sum_i Ki T Ki'/ni)/C, with Ki T Ki' = Ki Ki' + (ni-2) ri ri' and ri the row sums of Ki
+            tic_products = profiling.start()
+            R = sp.dot(K.K,Y)
+            km = R/ni # Mean kernel vector of each class, used for the prediction
+            Kw = K.K*sp.sqrt(w)
+            G = sp.dot(Kw,Kw.T)
+            del Kw
+            G += sp.dot(R*((ni-2)/ni),R.T)
+            G.flat[::n+1] += self.mu
+            G /= C
+            profiling.stop('products',tic_products,bytes=G.nbytes)
+            
+            # Solve the generalized eigenvalue problem
+            tic_eig = profiling.start()
+            a,A = linalg.eigh(G,b=K.K)
+            profiling.stop('eig',tic_eig)
+            profiling.event('eig',(n,a.size,'generalized'))
+            del G,R
+        else:
+            # Low rank factor of K and reduced problem: with A = L Q^-1 V and Q = L'L, (M + mu/C Q^-1) V = V diag(a)
+            if self.precomputed is None:
+                L = pivoted_cholesky(x,self.rank,sig=self.sig)
+            else:
+                L = pivoted_cholesky(None,self.rank,K=x.K)
+            tic_products = profiling.start()
+            P = sp.dot(L.T,Y)
+            km = sp.dot(L,P/ni)
+            Lw = L*sp.sqrt(w).reshape(n,1)
+            M = sp.dot(Lw.T,Lw)
+            del Lw
+            M += sp.dot(P*((ni-2)/ni),P.T)
+            Qi = linalg.cho_solve(linalg.cho_factor(sp.dot(L.T,L)),sp.eye(L.shape[1]))
+            M += self.mu*Qi
+            M /= C
+            profiling.stop('products',tic_products,bytes=M.nbytes)
+            tic_eig = profiling.start()
+            a,V = linalg.eigh(M)
+            profiling.stop('eig',tic_eig)
+            profiling.event('eig',(M.shape[0],a.size,'full'))
+            A = sp.dot(L,sp.dot(Qi,V))
+            del M,P,Qi,V
         idx = a.argsort()[::-1]
         a=a[idx]
         A=A[:,idx]
@@ -797,40 +2212,63 @@ class KDA: # Kernel QDA from "Toward an Optimal Supervised Classifier for the An
         a=a[t]
         A=A[:,t]
         
-        # Normalize the eigenvalue
-        for i in range(a.size):
-            A[:,i]/=sp.sqrt(sp.dot(sp.dot(A[:,i].T,K.K),A[:,i]))
-        
-        # Update model   
-        self.a=a.copy()
-        self.A=A.copy()
-        self.S= sp.dot(sp.dot(self.A,sp.diag(self.a**(-1))),self.A.T)
+        # Normalize the eigenvectors: A'KA = I (already verified by the low rank eigenvectors)
+        if self.rank is None:
+            A /= sp.sqrt(sp.sum(A*sp.dot(K.K,A),axis=0))
+            del K
         
-        # Free memory
-        del G,K,a,A
+        # Update model: the decision function of class i is ||(kt-km_i)A diag(a)^-1/2||^2, only the factor F = A diag(a)^-1/2
+        # and the projections q_i = km_i F of the mean kernel vectors are stored
+        self.a=a
+        A /= sp.sqrt(a)
+        self.F=A
+        self.q=[sp.dot(km[:,i],self.F) for i in range(C)]
+        if self.precomputed is None:
+            self.X=sp.array(x,dtype=sp.float64)
+            self.norms=sq_norms(self.X)
+        profiling.stop('KDA.train',tic,samples=n)
     
-    def predict(self,xt,x,y,out_decision=None,out_proba=None):
-        nt = xt.shape[0]
-        C = int(y.max())
-        D = sp.empty((nt,C))
-        D += self.prop
+    def predict(self,xt,x=None,y=None,out_decision=None,out_proba=None,shift=True):
+        '''
+        The function predicts the label for each sample with the learned model
+        Input:
+            xt: the test samples, for the precomputed case, xt is a KERNEL object with the kernel between xt and the
+                training samples
+            x,y: not used, kept for compatibility. The model stores its own training samples.
+            shift: if True, the decision functions are shifted such as their minimum over the test samples is zero
+                   (if negative). The labels and the posterior probabilities do not depend on it.
+        Output
+            yp: the label
+            D: the discriminant function
+            P: the posterior probabilities
+        '''
+        tic = profiling.start()
+        C = len(self.ni)
         eps = sp.finfo(sp.float64).eps
         
         # Pre compute the Gramm kernel matrix
         Kt = KERNEL()
-        Kt.compute_kernel(xt,z=x,sig=self.sig)
-        Ki = KERNEL()
-                
+        if self.precomputed is None:
+            Kt.compute_kernel(xt,z=self.X,sig=self.sig,norms=self.norms)
+        else:
+            Kt.K = xt.K
+        nt = Kt.K.shape[0]
+        D = sp.empty((nt,C))
+        
+        # Projection of the testing samples, shared by all the classes, in O(nt*n*r), in the type of the kernel
+        Q = sp.dot(Kt.K,sp.asarray(self.F,dtype=Kt.K.dtype))
+        del Kt
         for i in range(C):
-            t = sp.where(y==(i+1))[0]
-            Ki.compute_kernel(x,z=x[t,:],sig=self.sig)
-            T = Kt.K - sp.dot(Ki.K,sp.ones((self.ni[i]))/self.ni[i])
-            temp = sp.dot(T,self.S)
-            D[:,i] = sp.sum(T*temp,axis=1)
+            T = Q-self.q[i]
+            T **= 2
+            D[:,i] = sp.sum(T,axis=1)
+        profiling.stop('KDA.predict',tic,samples=nt)
         
         # Check if negative value
-        if D.min() <0:
-            D-=D.min()
+        Dmin = min(D.min(),0)
+        if shift:
+            D-=Dmin
+            Dmin = 0
         
         yp = D.argmin(1)+1
         yp.shape=(nt,1)
@@ -843,36 +2281,38 @@ class KDA: # Kernel QDA from "Toward an Optimal Supervised Classifier for the An
                 return yp,D
         else:        
             # Compute posterior !! Should be changed to a safe version
-            P = sp.exp(-0.5*D)
+            P = sp.exp(-0.5*(D-Dmin))
             P /= sp.sum(P,axis=1).reshape(nt,1)
             P[P<eps]=0                    
         return yp,D,P
     
-    def cross_validation(self,x,y,v=5,sig_r=2.0**sp.arange(-8,0),mu_r=10.0**sp.arange(-15,0)):
-        # Get parameters
-        n=x.shape[0]
-        ns = sig_r.size
-        nm = mu_r.size
-        err = sp.zeros((ns,nm))
-        
+    def cross_validation(self,x,y,v=5,sig_r=2.0**sp.arange(-8,0),mu_r=10.0**sp.arange(-15,0),n_jobs=1,search='grid'):
+        '''
+        The function selects the kernel parameter and the regularization parameter by v-fold cross-validation
+        Input:
+            x,y: the sample matrix and the label
+            v: the number of folds
+            sig_r: the values of the kernel parameter
+            mu_r: the values of the regularization parameter
+            n_jobs: the number of processes used to run the folds and the values of sig in parallel, -1 for all the cpus
+            search: 'grid' or 'halving', see PGPDA.cross_validation
+        Output:
+            sig,mu: the selected parameters
+            err: the classification error for each value of sig and mu
+            trace: the evaluations of the 'halving' search
+        '''
+        tic = profiling.start()
         # Initialization of the indices for the cross validation
         cv = CV()           
         cv.split_data_class(y,v=v)
         
-        for i in range(ns):
-            for j in range(nm):
-                for k in range(v):
-                    model_temp=KDA()
-                    model_temp.train(x[cv.it[k],:],y[cv.it[k]],sig=sig_r[i],mu=mu_r[j])
-                    yp = model_temp.predict(x[cv.iT[k],:],x[cv.it[k],:],y[cv.it[k]])
-                    yp.shape = y[cv.iT[k]].shape
-                    t = sp.where(yp!=y[cv.iT[k]])[0]
-                    err[i,j]+= float(t.size)/yp.size
-                    del model_temp
-        err/=v
+        if search == 'halving':
+            self.sig,self.mu,err,trace = search_halving(KDA(rank=self.rank),x,y,cv,sig_r,'mu',mu_r,n_jobs=n_jobs)
+            profiling.stop('KDA.cross_validation',tic)
+            return self.sig,self.mu,err,trace
+        err = run_cross_validation(KDA(rank=self.rank),x,y,cv,sig_r,'mu',mu_r,n_jobs=n_jobs)
         t = sp.where(err==err.min())
         self.sig = sig_r[t[0][0]]
         self.mu = mu_r[t[1][0]]
+        profiling.stop('KDA.cross_validation',tic)
         return sig_r[t[0][0]],mu_r[t[1][0]],err
-                    
-                
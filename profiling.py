@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+'''
+Performance counters of the stages of the pipeline (kernel computation, centering, eigen decomposition, parameter
+estimation, prediction, cross-validation...).
+
+The profiling is disabled by default: each instrumented stage then only costs a test of a global variable. When it is
+enabled, the time and the number of calls of each stage are accumulated in a STATS object, with the counters given by
+the stage (e.g. number of kernel entries, size in bytes of the computed matrices) and the events (e.g. the size of
+each eigen problem):
+
+    with profile() as stats:
+        model.train(x,y)
+    print stats.report()
+
+The stages are not nested: the time of a stage includes the time of the stages it calls (e.g. PGPDA.train includes
+kernel and eig). The stages run in worker processes (n_jobs > 1 with processes) are not recorded, only the stage
+which runs the pool; the stages run in threads are.
+'''
+import sys
+import time
+import threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+STATS_ = None # The STATS object of the enabled profiling, None when the profiling is disabled
+
+class STATS:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Clear the counters
+        '''
+        self.time = {}       # Total time (s) of each stage
+        self.calls = {}      # Number of calls of each stage
+        self.counters = {}   # Sum of the counters of each stage, e.g. self.counters['kernel']['entries']
+        self.peak_bytes = {} # Size of the largest matrix computed by each stage
+        self.events = {}     # List of the events, e.g. self.events['eig'] = [(n,k,solver),...], see event
+
+    def add(self,name,t,counters):
+        '''
+        Add a call of a stage
+        Input:
+            name: the name of the stage
+            t: the time of the call
+            counters: a dictionary of counters, the counter 'bytes' is also used for the peak size
+        '''
+        with self.lock:
+            self.time[name] = self.time.get(name,0.0)+t
+            self.calls[name] = self.calls.get(name,0)+1
+            if counters:
+                c = self.counters.setdefault(name,{})
+                for key in counters:
+                    c[key] = c.get(key,0)+counters[key]
+                if 'bytes' in counters:
+                    self.peak_bytes[name] = max(self.peak_bytes.get(name,0),counters['bytes'])
+
+    def add_event(self,name,value):
+        with self.lock:
+            self.events.setdefault(name,[]).append(value)
+
+    def max_rss(self):
+        '''
+        Peak resident memory of the process, in bytes (None if not available)
+        '''
+        if resource is None:
+            return None
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return r if sys.platform == 'darwin' else 1024*r # bytes on OS X, kB on Linux
+
+    def as_dict(self):
+        '''
+        The counters as a dictionary of basic types, e.g. to be written in JSON
+        '''
+        with self.lock:
+            stages = {}
+            for name in self.time:
+                stages[name] = {'time':self.time[name],'calls':self.calls[name]}
+                stages[name].update(self.counters.get(name,{}))
+                if name in self.peak_bytes:
+                    stages[name]['peak_bytes'] = self.peak_bytes[name]
+            events = dict([(name,list(self.events[name])) for name in self.events])
+        return {'stages':stages,'events':events,'max_rss':self.max_rss()}
+
+    def report(self):
+        '''
+        The counters as a table, the stages being sorted by decreasing time
+        '''
+        d = self.as_dict()
+        lines = ['%-28s%10s%8s%14s%12s'%('stage','time (s)','calls','entries','peak (MB)')]
+        for name in sorted(d['stages'],key=lambda name:-d['stages'][name]['time']):
+            s = d['stages'][name]
+            lines.append('%-28s%10.4f%8d%14s%12s'%(name,s['time'],s['calls'],s.get('entries',''),
+                                                    '%.1f'%(s['peak_bytes']/2.0**20) if 'peak_bytes' in s else ''))
+        for name in sorted(d['events']):
+            largest = max(d['events'][name],key=event_size)
+            lines.append('%s: %d events, largest %s'%(name,len(d['events'][name]),str(largest)))
+        if d['max_rss'] is not None:
+            lines.append('peak resident memory: %.1f MB'%(d['max_rss']/2.0**20))
+        return '\n'.join(lines)
+
+def enable(stats=None):
+    '''
+    Enable the profiling
+    Input:
+        stats: the STATS object where the counters are accumulated, a new one if None
+    Output:
+        the STATS object
+    '''
+    global STATS_
+    STATS_ = STATS() if stats is None else stats
+    return STATS_
+
+def disable():
+    '''
+    Disable the profiling
+    Output:
+        the STATS object of the profiling, None if it was not enabled
+    '''
+    global STATS_
+    stats,STATS_ = STATS_,None
+    return stats
+
+@contextmanager
+def profile(stats=None):
+    '''
+    Enable the profiling in a with block, the previous state is restored at the end of the block
+    '''
+    global STATS_
+    previous = STATS_
+    stats = enable(stats)
+    try:
+        yield stats
+    finally:
+        STATS_ = previous
+
+def start():
+    '''
+    Start a stage: returns the current time, or None when the profiling is disabled
+    '''
+    if STATS_ is None:
+        return None
+    return time.time()
+
+def stop(name,tic,**counters):
+    '''
+    Stop a stage started with start, the counters are added to those of the stage (e.g. entries=K.size,bytes=K.nbytes)
+    '''
+    if (tic is None) or (STATS_ is None):
+        return
+    STATS_.add(name,time.time()-tic,counters)
+
+def event_size(value):
+    '''
+    The size of an event: its first element for a tuple, the value otherwise
+    '''
+    return value[0] if isinstance(value,(tuple,list)) else value
+
+def event(name,value):
+    '''
+    Record an event, e.g. the size of an eigen problem. The value is a number or a tuple whose first element is the size
+    of the event, e.g. (n,k,solver) for the eigen problems: report shows the largest one.
+    '''
+    if STATS_ is not None:
+        STATS_.add_event(name,value)